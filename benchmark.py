@@ -0,0 +1,382 @@
+"""Load benchmark for tagblog endpoints.
+
+Seeds a SQLite database, drives the endpoints through the Flask test
+client and through a local waitress server, and prints latency
+percentiles, requests per second and SQL statements per request as
+JSON. Seeded databases are reused between runs with the same seed
+parameters, so runs on different commits can be compared. They are
+only read: every driver runs on a fresh copy of the seeded database,
+so writes of one run do not change the data of the next.
+
+    python benchmark.py --posts 100000 --tags 500 --density 3
+
+"""
+import argparse
+import httplib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+# Search terms are drawn from this vocabulary. Word frequencies follow
+# Zipf's law roughly like in real text.
+VOCABULARY = ['w%d' % i for i in range(5000)]
+WEIGHTS = [1.0 / (rank + 1) for rank in range(len(VOCABULARY))]
+# Scenarios of a logged in user, others are read anonymously like most
+# readers do
+LOGGED_IN = ('addpost', 'editpost', 'edittags_get', 'edittags_post')
+# Scenarios writing data, they are run last
+WRITES = ('addpost', 'editpost', 'edittags_post')
+
+
+def post_words(seed, index):
+    """Return deterministic list of words of post number index."""
+    rng = random.Random('%s-%d' % (seed, index))
+    return [VOCABULARY[_weighted(rng)] for _ in range(rng.randint(30, 200))]
+
+
+def _weighted(rng, _total=[]):
+    if not _total:
+        total = 0.0
+        for weight in WEIGHTS:
+            total += weight
+            _total.append(total)
+    point = rng.random() * _total[-1]
+    low, high = 0, len(_total) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if _total[middle] < point:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def seed_lines(args):
+    """Yield JSON lines of generated posts."""
+    rng = random.Random(args.seed)
+    for index in range(args.posts):
+        words = post_words(args.seed, index)
+        yield json.dumps({
+            'title': ' '.join(words[:5]),
+            'body': ' '.join(words),
+            'tags': ['tag%d' % rng.randrange(args.tags)
+                     for _ in range(args.density)]})
+
+
+def scenarios(args, tagblog):
+    """Return dictionary of scenario name to request factory.
+
+    Factories are called with a random generator and return
+    (method, path, form data or None).
+
+    """
+    max_id = (tagblog.db.session.query(tagblog.db.func.max(
+        tagblog.Blogpost.id)).scalar() or 0)
+    last_page = max(tagblog.count_pages(max_id), 1)
+    deep_cursor = tagblog.encode_cursor(last_page,
+                                        max(max_id - tagblog.POSTS_PER_PAGE, 0))
+    tags = tagblog.db.session.query(tagblog.Tag.id, tagblog.Tag.name).all()
+    tagblog.db.session.remove()
+
+    def search(terms):
+        def factory(rng):
+            words = post_words(args.seed, rng.randrange(args.posts))
+            query = ' '.join(rng.sample(words, min(terms, len(words))))
+            return 'GET', '/search?' + urllib.urlencode({'query': query}), None
+        return factory
+
+    def addpost(rng):
+        return 'POST', '/addpost', {
+            'title': 'benchmark post',
+            'body': ' '.join(post_words(args.seed, rng.randrange(args.posts))),
+            'tags': [str(id) for id, name in rng.sample(tags, min(
+                args.density, len(tags)))]}
+
+    def editpost(rng):
+        return 'POST', '/editpost', {
+            'id': str(rng.randint(1, max_id)),
+            'title': 'edited post',
+            'body': ' '.join(post_words(args.seed, rng.randrange(args.posts))),
+            'tags': [str(id) for id, name in rng.sample(tags, min(
+                args.density, len(tags)))]}
+
+    def edittags_post(rng):
+        data = {}
+        for i, (id, name) in enumerate(tags):
+            data['tags-%d-id' % i] = str(id)
+            data['tags-%d-name' % i] = name
+        return 'POST', '/edittags', data
+
+    found = {
+        'index': lambda rng: ('GET', '/', None),
+        'deep_page_numbered': lambda rng: ('GET', '/%d' % last_page, None),
+        'deep_page_cursor': lambda rng: (
+            'GET', '/?after=' + deep_cursor, None),
+        'post': lambda rng: (
+            'GET', '/post/%d' % rng.randint(1, max_id), None),
+        'addpost': addpost,
+        'editpost': editpost,
+        'edittags_get': lambda rng: ('GET', '/edittags', None),
+        'edittags_post': edittags_post,
+        }
+    for terms in args.search_terms:
+        found['search_%d' % terms] = search(terms)
+    return found
+
+
+class TestClientDriver(object):
+    """Sends requests through the Flask test client.
+
+    Logs in if username is given.
+
+    """
+
+    def __init__(self, app, username=None, password=None):
+        self.client = app.test_client()
+        if username:
+            self.client.post('/login', data={'username': username,
+                                              'password': password})
+
+    def request(self, method, path, data):
+        if method == 'GET':
+            response = self.client.get(path)
+        else:
+            response = self.client.post(path, data=data)
+        # Streamed pages are rendered while they are read
+        response.data
+        return response.status_code
+
+
+class HTTPDriver(object):
+    """Sends requests to a local server over a kept-alive connection.
+
+    Logs in if username is given.
+
+    """
+
+    def __init__(self, port, username=None, password=None):
+        self.port = port
+        self.connection = httplib.HTTPConnection('127.0.0.1', port)
+        self.cookie = None
+        if username:
+            self.request('POST', '/login', {'username': username,
+                                            'password': password})
+
+    def request(self, method, path, data):
+        headers = {}
+        body = None
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if data is not None:
+            body = urllib.urlencode(data, doseq=True)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        response.read()
+        cookie = response.getheader('set-cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        if response.getheader('connection', '').lower() == 'close':
+            self.connection.close()
+            self.connection = httplib.HTTPConnection('127.0.0.1', self.port)
+        return response.status
+
+
+def run_scenario(drivers, factory, requests, seed, statements):
+    """Run requests split over drivers. Returns result dictionary."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_driver = [requests // len(drivers) +
+                  (1 if i < requests % len(drivers) else 0)
+                  for i in range(len(drivers))]
+
+    def work(driver, count, rng):
+        for _ in range(count):
+            method, path, data = factory(rng)
+            started = time.time()
+            status = driver.request(method, path, data)
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                if status >= 500:
+                    errors.append(status)
+
+    before = statements[0]
+    started = time.time()
+    threads = [threading.Thread(target=work, args=(
+                   driver, count, random.Random('%s-%d' % (seed, i))))
+               for i, (driver, count) in enumerate(zip(drivers, per_driver))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    latencies.sort()
+
+    def percentile(fraction):
+        index = min(int(round(fraction * len(latencies) + 0.5)) - 1,
+                    len(latencies) - 1)
+        return round(latencies[max(index, 0)] * 1000, 3)
+
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'queries_per_request': round(float(statements[0] - before) /
+                                         max(len(latencies), 1), 2)}
+
+
+def fresh_copy(tagblog, database, scratch):
+    """Replace scratch database with a copy of database.
+
+    Job workers are stopped and connections closed first. The copy is
+    renamed into place, so connections left open never see it half
+    written. Caches of the process are emptied too.
+
+    """
+    tagblog.jobs.stop()
+    tagblog.db.session.remove()
+    tagblog.db.engine.dispose()
+    shutil.copy(database, scratch + '.tmp')
+    os.rename(scratch + '.tmp', scratch)
+    tagblog.tag_choices.invalidate()
+    for cache in (tagblog.post_counts, tagblog.response_cache.backend, 
+                  tagblog.user_cache, tagblog.snippet_cache, 
+                  tagblog.search_results, tagblog.feeds):
+        cache.clear()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--tags', type=int, default=200)
+    parser.add_argument('--density', type=int, default=3,
+                        help='tags per post')
+    parser.add_argument('--seed', default='tagblog')
+    parser.add_argument('--database-dir', default=tempfile.gettempdir(),
+                        help='where seeded databases are kept')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='clients and waitress threads')
+    parser.add_argument('--search-terms', type=int, nargs='+',
+                        default=[1, 2, 5, 10, 20])
+    parser.add_argument('--drivers', nargs='+', default=['client', 'waitress'],
+                        choices=['client', 'waitress'])
+    parser.add_argument('--scenarios', nargs='+',
+                        help='run only these scenarios')
+    parser.add_argument('--response-cache', action='store_true',
+                        help='cache pages of anonymous readers')
+    parser.add_argument('--output', help='file to write JSON to')
+    args = parser.parse_args(argv)
+
+    database = os.path.join(args.database_dir, 'tagblog-bench-%s-%d-%d-%d.db' %
+                            (args.seed, args.posts, args.tags, args.density))
+    seeded = os.path.exists(database)
+    handle, scratch = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    if seeded:
+        shutil.copy(database, scratch)
+    settings = tempfile.NamedTemporaryFile(suffix='.py', delete=False)
+    settings.write('SQLALCHEMY_DATABASE_URI = %r\nCSRF_ENABLED = False\n'
+                   'FEED_DIR = %r\nRESPONSE_CACHE_ENABLED = %r\n' % (
+                       'sqlite:///' + scratch, tempfile.mkdtemp(), 
+                       args.response_cache))
+    settings.close()
+    os.environ['TAGBLOG_SETTINGS_FILE'] = settings.name
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    import tagblog
+    import manage
+    from sqlalchemy import event
+    os.unlink(settings.name)
+
+    manage.migrate()
+    if not seeded:
+        started = time.time()
+        manage.import_posts(seed_lines(args), chunk_size=5000)
+        sys.stderr.write('seeded %d posts in %.1f s\n' %
+                         (args.posts, time.time() - started))
+    if not tagblog.User.query.filter_by(username='benchmark').first():
+        tagblog.db.session.add(tagblog.User('benchmark', 'benchmark'))
+        tagblog.db.session.commit()
+    tagblog.db.session.remove()
+    tagblog.db.engine.dispose()
+    shutil.copy(scratch, database)
+
+    statements = [0]
+
+    @event.listens_for(tagblog.db.engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    found = scenarios(args, tagblog)
+    names = args.scenarios or sorted(found, key=lambda name: name in WRITES)
+    report = {'revision': git_revision(),
+              'config': {'posts': args.posts, 'tags': args.tags,
+                         'density': args.density, 'seed': args.seed,
+                         'requests': args.requests,
+                         'concurrency': args.concurrency,
+                         'response_cache': args.response_cache},
+              'results': {}}
+    for kind in args.drivers:
+        fresh_copy(tagblog, database, scratch)
+        server = None
+        if kind == 'client':
+            anonymous = [TestClientDriver(tagblog.app)]
+            logged_in = [TestClientDriver(tagblog.app, 'benchmark', 
+                                          'benchmark')]
+        else:
+            from waitress.server import create_server
+            server = create_server(tagblog.app, host='127.0.0.1', port=0,
+                                   threads=args.concurrency)
+            thread = threading.Thread(target=server.run)
+            thread.daemon = True
+            thread.start()
+            anonymous = [HTTPDriver(server.effective_port)
+                         for _ in range(args.concurrency)]
+            logged_in = [HTTPDriver(server.effective_port, 'benchmark',
+                                    'benchmark')
+                         for _ in range(args.concurrency)]
+        results = report['results'][kind] = {}
+        for name in names:
+            sys.stderr.write('%s %s\n' % (kind, name))
+            drivers = logged_in if name in LOGGED_IN else anonymous
+            results[name] = run_scenario(drivers, found[name], args.requests,
+                                         args.seed, statements)
+        if server:
+            for driver in anonymous + logged_in:
+                driver.connection.close()
+            server.task_dispatcher.shutdown()
+            server.close()
+            thread.join(5)
+    tagblog.jobs.stop()
+    os.unlink(scratch)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
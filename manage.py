@@ -0,0 +1,824 @@
+"""Command line tools for tagblog.
+
+Run python manage.py --help for the commands.
+
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import posixpath
+import re
+import shutil
+import sys
+import time
+import urllib
+import urllib2
+from collections import Counter
+from gzip import GzipFile
+from StringIO import StringIO
+
+from flask import url_for
+from sqlalchemy.engine.reflection import Inspector
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from tagblog import (app, db, Blogpost, Tag, Posting, ContentVersion, Job, 
+                     tagsTable, chunks, postings, bump_versions, 
+                     make_excerpt, jobs, rebuild_search_index, 
+                     recount_tags, rebuild_excerpts, utcnow, count_pages, 
+                     POSTS_PER_PAGE, STATIC_SITE, ASSET_BUNDLES, assets)
+
+
+def export_posts(out, chunk_size=1000):
+    """Write every post as one JSON object per line.
+
+    Posts are read chunk_size at a time by id, so memory use does not
+    grow with the amount of posts. Returns amount of exported posts.
+
+    Keyword arguments:
+    out -- file like object to write to
+    chunk_size -- amount of posts read per query
+
+    """
+    post = Blogpost.__table__
+    tag = Tag.__table__
+    last = 0
+    exported = 0
+    while True:
+        rows = db.session.execute(
+            db.select([post.c.id, post.c.title, post.c.body])
+            .where(post.c.id > last)
+            .order_by(post.c.id)
+            .limit(chunk_size)).fetchall()
+        if not rows:
+            return exported
+        last = rows[-1].id
+        tags = {}
+        for blogpost_id, name in db.session.execute(
+                db.select([tagsTable.c.blogpost_id, tag.c.name],
+                          tagsTable.c.tag_id == tag.c.id)
+                .where(tagsTable.c.blogpost_id.between(rows[0].id, last))
+                .order_by(tag.c.name)):
+            tags.setdefault(blogpost_id, []).append(name)
+        for row in rows:
+            out.write(json.dumps({'id': row.id,
+                                  'title': row.title,
+                                  'body': row.body,
+                                  'tags': tags.get(row.id, [])}))
+            out.write('\n')
+        exported += len(rows)
+
+
+def import_posts(lines, chunk_size=1000, keep_ids=False, report=None):
+    """Insert posts from JSON lines written by export_posts.
+
+    Posts, their tag associations, search index rows and tag post
+    counts are written with one executemany per chunk and committed
+    per chunk. Missing tags are created. Only one chunk is held in
+    memory at a time.
+    Nothing else should write posts while importing.
+    Returns amount of imported posts.
+
+    Keyword arguments:
+    lines -- iterable of JSON lines
+    chunk_size -- amount of posts inserted per transaction
+    keep_ids -- use ids from the lines instead of new ones
+    report -- called with amount of imported posts after each chunk
+
+    """
+    next_id = (db.session.query(db.func.max(Blogpost.id)).scalar() or 0) + 1
+    tag_ids = {}
+    imported = 0
+    chunk = []
+    for line in lines:
+        if line.strip():
+            chunk.append(json.loads(line))
+        if len(chunk) >= chunk_size:
+            next_id = _import_chunk(chunk, next_id, keep_ids, tag_ids)
+            imported += len(chunk)
+            chunk = []
+            if report:
+                report(imported)
+    if chunk:
+        _import_chunk(chunk, next_id, keep_ids, tag_ids)
+        imported += len(chunk)
+        if report:
+            report(imported)
+    if db.engine.dialect.name == 'postgresql':
+        # Explicit ids bypass the id sequence
+        db.session.execute("SELECT setval(pg_get_serial_sequence("
+                           "'blogpost', 'id'), max(id)) FROM blogpost")
+    bump_versions('listing', 'tags')
+    db.session.commit()
+    return imported
+
+
+def _import_chunk(records, next_id, keep_ids, tag_ids):
+    """Insert one chunk of records. Returns next free post id."""
+    _resolve_tags(set(name for record in records
+                      for name in record.get('tags', [])), tag_ids)
+    posts, tags, index = [], [], []
+    for record in records:
+        if keep_ids:
+            id = int(record['id'])
+            next_id = max(next_id, id + 1)
+        else:
+            id = next_id
+            next_id += 1
+        posts.append({'id': id,
+                      'title': record.get('title'),
+                      'body': record.get('body'),
+                      'excerpt': make_excerpt(record.get('body'))})
+        tags.extend({'tag_id': tag_ids[name], 'blogpost_id': id}
+                    for name in set(record.get('tags', [])))
+        index.extend(postings(id, record.get('title'), record.get('body')))
+    db.session.execute(Blogpost.__table__.insert(), posts)
+    if tags:
+        db.session.execute(tagsTable.insert(), tags)
+        counts = Counter(row['tag_id'] for row in tags)
+        tag = Tag.__table__
+        db.session.execute(
+            tag.update()
+            .where(tag.c.id == db.bindparam('tag_id'))
+            .values(post_count=tag.c.post_count + db.bindparam('count')),
+            [{'tag_id': id, 'count': count}
+             for id, count in counts.iteritems()])
+    if index:
+        db.session.execute(Posting.__table__.insert(), index)
+    db.session.commit()
+    return next_id
+
+
+def _resolve_tags(names, tag_ids):
+    """Add ids of tag names to tag_ids, creating missing tags."""
+    names = names - set(tag_ids)
+    for chunk in chunks(names):
+        tag_ids.update(db.session.query(Tag.name, Tag.id)
+                       .filter(Tag.name.in_(chunk)))
+    missing = names - set(tag_ids)
+    if missing:
+        db.session.execute(Tag.__table__.insert(),
+                           [{'name': name} for name in missing])
+        for chunk in chunks(missing):
+            tag_ids.update(db.session.query(Tag.name, Tag.id)
+                           .filter(Tag.name.in_(chunk)))
+
+
+def site_pages():
+    """Return dictionary of file name to (fingerprint, url) of site pages.
+
+    A fingerprint changes when anything shown on the page changes: its
+    posts, their versions and tags, the amount of pages or templates.
+    Everything is read with a few queries, without loading posts.
+
+    """
+    post = Blogpost.__table__
+    tag = Tag.__table__
+    salt = _templates_fingerprint()
+    posts = db.session.execute(
+        db.select([post.c.id, post.c.version]).order_by(post.c.id)).fetchall()
+    post_tags = {}
+    tag_posts = {}
+    for blogpost_id, name in db.session.execute(
+            db.select([tagsTable.c.blogpost_id, tag.c.name], 
+                      tagsTable.c.tag_id == tag.c.id)
+            .order_by(tagsTable.c.blogpost_id, tag.c.name)):
+        post_tags.setdefault(blogpost_id, []).append(name)
+        tag_posts.setdefault(name, []).append(blogpost_id)
+    versions = dict(posts)
+    shown = lambda ids: [(id, versions.get(id), post_tags.get(id)) 
+                         for id in ids]
+    counts = db.session.execute(
+        db.select([tag.c.name, tag.c.post_count])
+        .where(tag.c.post_count > 0).order_by(tag.c.name)).fetchall()
+
+    found = {}
+    with app.test_request_context(
+            base_url=app.config.get('SITE_URL', 'http://localhost/')):
+        def add(url, *content):
+            found[_page_file(url)] = (_fingerprint(salt, *content), url)
+        add(url_for('tags'), [tuple(row) for row in counts])
+        ids = [id for id, version in posts]
+        pages = count_pages(len(ids))
+        for page in range(1, max(pages, 1) + 1):
+            if page > 1:
+                url = url_for('index', page=page)
+            else:
+                url = url_for('index')
+            add(url, pages, 
+                shown(ids[(page-1)*POSTS_PER_PAGE:page*POSTS_PER_PAGE]))
+        for name, count in counts:
+            ids = sorted(tag_posts.get(name, []))
+            pages = count_pages(count)
+            for page in range(1, pages + 1):
+                if page > 1:
+                    url = url_for('tag', name=name, page=page)
+                else:
+                    url = url_for('tag', name=name)
+                add(url, pages, 
+                    shown(ids[(page-1)*POSTS_PER_PAGE:page*POSTS_PER_PAGE]))
+        for id, version in posts:
+            add(url_for('post', id=id), version, post_tags.get(id))
+    return dict((name, page) for name, page in found.iteritems() 
+                if name is not None)
+
+
+def _templates_fingerprint():
+    digest = hashlib.sha1(app.config.get('SITE_URL', ''))
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in sorted(os.walk(folder)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as template:
+                digest.update(template.read())
+    # Pages link built assets by their hashed names
+    digest.update(json.dumps(assets.manifest(), sort_keys=True))
+    return digest.hexdigest()
+
+
+def _fingerprint(*content):
+    return hashlib.sha1(repr(content)).hexdigest()
+
+
+def _page_file(url):
+    """Return file name of page url or None if it can not be a file."""
+    parts = [part for part in urllib.unquote(url).split('/') if part]
+    if any(part in ('.', '..') or '\0' in part for part in parts):
+        return None
+    return '/'.join(parts + ['index.html'])
+
+
+def site_assets():
+    """Return dictionary of file name to (fingerprint, path) of assets."""
+    found = {}
+    for folder, prefix in ((app.static_folder, 'static/'), 
+                           (assets.directory, 'static/build/')):
+        for root, dirs, files in os.walk(folder):
+            if root == app.static_folder and 'build' in dirs:
+                dirs.remove('build')
+            for name in files:
+                path = os.path.join(root, name)
+                if path == os.path.join(assets.directory, 'manifest.json'):
+                    continue
+                stat = os.stat(path)
+                found[prefix + os.path.relpath(path, folder)] = (
+                    _fingerprint(stat.st_size, stat.st_mtime), path)
+    return found
+
+
+def export_site(directory, processes=None, report=None):
+    """Render every page of the site as files for a plain web server.
+
+    Each export is a new generation directory under directory. It
+    starts as hard links to the previous one, and only pages whose
+    fingerprint differs from the manifest of the previous export are
+    rendered, in a pool of processes. The current symlink is switched
+    to the generation when it is complete, so the web server, with
+    its root at directory/current, never serves a half written export.
+    Returns amount of written files.
+
+    Keyword arguments:
+    directory -- where the generations and the manifest are kept
+    processes -- size of the rendering pool, default amount of cores
+    report -- called with amount of written files after each chunk
+
+    """
+    manifest = _read_manifest(directory)
+    previous = None
+    if manifest:
+        previous = _generation(directory, manifest['generation'])
+        if not os.path.isdir(previous):
+            manifest, previous = None, None
+    known = manifest['files'] if manifest else {}
+    number = manifest['generation'] + 1 if manifest else 1
+    target = _generation(directory, number)
+    if os.path.exists(target):
+        # Left from an export that did not finish
+        shutil.rmtree(target)
+    if previous:
+        _link_tree(previous, target)
+    else:
+        os.makedirs(target)
+
+    pages = site_pages()
+    assets = site_assets()
+    db.session.remove()
+    files = dict((name, fingerprint) 
+                 for name, (fingerprint, source) 
+                 in pages.items() + assets.items())
+    for name in set(known) - set(files):
+        _remove_file(target, name)
+    written = 0
+    for name, (fingerprint, path) in assets.iteritems():
+        if known.get(name) != fingerprint:
+            with open(path, 'rb') as source:
+                _write_file(target, name, source.read())
+            written += 1
+    changed = [(name, url) for name, (fingerprint, url) in pages.iteritems() 
+               if known.get(name) != fingerprint]
+    work = [(target, chunk) for chunk in chunks(changed, 100)]
+    if processes == 1 or len(work) <= 1:
+        results = (_render_pages(item) for item in work)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_renderer)
+        results = pool.imap_unordered(_render_pages, work)
+    for count, failed in results:
+        written += count
+        for name in failed:
+            del files[name]
+        if report:
+            report(written)
+    if processes != 1 and len(work) > 1:
+        pool.close()
+        pool.join()
+
+    _write_manifest(directory, {'generation': number, 'files': files})
+    link = os.path.join(directory, 'current')
+    temporary = '%s.%d' % (link, os.getpid())
+    os.symlink(os.path.relpath(target, directory), temporary)
+    os.rename(temporary, link)
+    # The previous generation may still be read by requests in flight
+    for name in os.listdir(os.path.join(directory, 'generations')):
+        if name not in (str(number), str(number - 1)):
+            shutil.rmtree(_generation(directory, name))
+    return written
+
+
+def _generation(directory, number):
+    return os.path.join(directory, 'generations', str(number))
+
+
+def _read_manifest(directory):
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as manifest:
+            return json.load(manifest)
+    except IOError:
+        return None
+
+
+def _write_manifest(directory, manifest):
+    path = os.path.join(directory, 'manifest.json')
+    with open(path + '.tmp', 'w') as out:
+        json.dump(manifest, out)
+    os.rename(path + '.tmp', path)
+
+
+def _link_tree(source, target):
+    """Make target a copy of directory tree source with hard links."""
+    for root, dirs, files in os.walk(source):
+        copy = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(copy)
+        for name in files:
+            os.link(os.path.join(root, name), os.path.join(copy, name))
+
+
+def _write_file(target, name, data):
+    # Files are linked from the previous generation, so they are
+    # replaced by rename instead of written over
+    path = os.path.join(target, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'wb') as out:
+        out.write(data)
+    os.rename(path + '.tmp', path)
+
+
+def _remove_file(target, name):
+    try:
+        os.remove(os.path.join(target, name))
+        os.removedirs(os.path.dirname(os.path.join(target, name)))
+    except OSError:
+        pass
+
+
+def _init_renderer():
+    # Connections of the parent process must not be shared
+    db.engine.dispose()
+
+
+def _render_pages(work):
+    """Render pages of (target, [(file name, url)]) to their files.
+
+    Returns amount of written files and list of pages which were
+    not found any more.
+
+    """
+    target, pages = work
+    written = 0
+    failed = []
+    for name, url in pages:
+        with app.test_request_context(
+                url, base_url=app.config.get('SITE_URL', 'http://localhost/'), 
+                environ_base={STATIC_SITE: True}):
+            response = app.preprocess_request()
+            if response is None:
+                response = app.dispatch_request()
+            response = app.make_response(response)
+        if response.status_code == 200:
+            _write_file(target, name, response.data)
+            written += 1
+        else:
+            _remove_file(target, name)
+            failed.append(name)
+    db.session.remove()
+    return written, failed
+
+
+def build_assets(report=None):
+    """Build bundles of ASSET_BUNDLES with compressed copies.
+
+    Files are minified by using their .min siblings. Stylesheets
+    without one are minified here and other files are used as they
+    are. Bundles are named by a hash of their content and listed in
+    the manifest, which is written last. Files of the previous build
+    are kept for pages rendered before it. Returns the manifest.
+
+    Keyword arguments:
+    report -- called with name and size of each built bundle
+
+    """
+    directory = assets.directory
+    previous = assets.manifest()
+    manifest = {}
+    for bundle, names in ASSET_BUNDLES.iteritems():
+        data = _bundle(bundle, names)
+        base, extension = posixpath.splitext(bundle)
+        built = '%s.%s%s' % (base, hashlib.sha1(data).hexdigest()[:12], 
+                             extension)
+        path = os.path.join(directory, built)
+        if not os.path.exists(path):
+            _write_asset(path, data)
+            _write_asset(path + '.gz', _gzip(data))
+            if brotli is not None:
+                _write_asset(path + '.br', brotli.compress(data))
+        manifest[bundle] = built
+        if report:
+            report(built, len(data))
+    _write_asset(os.path.join(directory, 'manifest.json'), 
+                 json.dumps(manifest, indent=2, sort_keys=True))
+    keep = set(manifest.values()) | set(previous.values())
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            built = os.path.relpath(os.path.join(root, name), directory)
+            built = re.sub(r'\.(gz|br)$', '', built.replace(os.sep, '/'))
+            if built != 'manifest.json' and built not in keep:
+                os.remove(os.path.join(root, name))
+    assets.reload()
+    return manifest
+
+
+# url() of stylesheets, relative ones are made relative to the bundle
+_css_url_re = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def _bundle(bundle, names):
+    parts = []
+    for name in names:
+        base, extension = posixpath.splitext(name)
+        minified = os.path.join(app.static_folder, base + '.min' + extension)
+        if os.path.exists(minified):
+            with open(minified, 'rb') as source:
+                data = source.read()
+        else:
+            with open(os.path.join(app.static_folder, name), 'rb') as source:
+                data = source.read()
+            if extension == '.css':
+                data = minify_css(data)
+        if extension == '.css':
+            data = _rebase_css(data, posixpath.dirname(name), 
+                               posixpath.join('build', 
+                                              posixpath.dirname(bundle)))
+        parts.append(data.strip())
+    # Scripts may leave out their last semicolon
+    return (';\n' if bundle.endswith('.js') else '\n').join(parts) + '\n'
+
+
+def _rebase_css(data, source, target):
+    def rebase(match):
+        quote, url = match.groups()
+        if url.startswith(('/', 'data:', '#')) or ':' in url.split('/')[0]:
+            return match.group(0)
+        url = posixpath.normpath(posixpath.join(source, url))
+        url = posixpath.relpath(url, target)
+        return 'url(%s%s%s)' % (quote, url, quote)
+    return _css_url_re.sub(rebase, data)
+
+
+def minify_css(data):
+    """Return stylesheet without comments and extra whitespace.
+
+    Comments starting with /*! are kept, they hold licenses.
+
+    """
+    data = re.sub(r'/\*(?!!).*?\*/', '', data, flags=re.S)
+    data = re.sub(r'\s+', ' ', data)
+    data = re.sub(r' ?([{};,>]) ?', r'\1', data)
+    return data.replace(';}', '}').strip()
+
+
+def _gzip(data):
+    out = StringIO()
+    # Fixed mtime keeps builds of the same content identical
+    with GzipFile(filename='', mode='wb', fileobj=out, 
+                  compresslevel=9, mtime=0) as compressed:
+        compressed.write(data)
+    return out.getvalue()
+
+
+def _write_asset(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    temporary = '%s.%d' % (path, os.getpid())
+    with open(temporary, 'wb') as out:
+        out.write(data)
+    os.rename(temporary, path)
+
+
+# jQuery the templates loaded from the Google CDN before it was vendored
+JQUERY_VERSION = '1.10.1'
+JQUERY_URL = 'https://code.jquery.com/jquery-%s%s.js'
+
+
+def vendor_jquery(version=JQUERY_VERSION):
+    """Download jQuery of version to static/js/jquery.js and .min.js.
+
+    Both files are downloaded before either is written. Raises
+    ValueError if a file is not of the version.
+
+    """
+    files = []
+    for suffix in ('', '.min'):
+        data = urllib2.urlopen(JQUERY_URL % (version, suffix)).read()
+        if jquery_version(data) != version:
+            raise ValueError('jquery-%s%s.js is not jQuery %s' % 
+                             (version, suffix, version))
+        files.append((os.path.join(app.static_folder, 'js', 
+                                   'jquery%s.js' % suffix), data))
+    for path, data in files:
+        _write_asset(path, data)
+
+
+def jquery_version(data):
+    """Return version in the license comment of jQuery source or None."""
+    match = re.search(r'jQuery (?:JavaScript Library )?v(\S+)', data[:500])
+    return match.group(1) if match else None
+
+
+def _inspector():
+    return Inspector.from_engine(db.session.connection())
+
+
+def _add_column(table, name, fill=None):
+    """Add column of table to database unless it is there already.
+
+    Keyword arguments:
+    table -- Table of the model
+    name -- name of the column
+    fill -- value for existing rows
+
+    """
+    if name in [c['name'] for c in _inspector().get_columns(table.name)]:
+        return
+    column = table.c[name]
+    dialect = db.session.connection().dialect
+    quote = dialect.identifier_preparer
+    db.session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+        quote.format_table(table), quote.format_column(column),
+        column.type.compile(dialect=dialect)))
+    if fill is not None:
+        db.session.execute(table.update().values({name: fill}))
+    # SQLite can not change columns, there they stay nullable
+    if not column.nullable and dialect.name != 'sqlite':
+        db.session.execute('ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (
+            quote.format_table(table), quote.format_column(column)))
+
+
+def _create_table(table):
+    table.create(bind=db.session.connection(), checkfirst=True)
+
+
+def _create_indexes(table):
+    existing = set(index['name'] for index in 
+                   _inspector().get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(bind=db.session.connection())
+
+
+def _search_index():
+    _create_table(Posting.__table__)
+
+
+def _tag_counts():
+    _add_column(Tag.__table__, 'post_count', fill=0)
+    _create_indexes(tagsTable)
+
+
+def _post_versions():
+    _add_column(Blogpost.__table__, 'version', fill=1)
+    _add_column(Blogpost.__table__, 'updated', fill=utcnow())
+
+
+def _excerpts():
+    _add_column(Blogpost.__table__, 'excerpt')
+
+
+def _job_queue():
+    _create_table(Job.__table__)
+
+
+def _job_attempts():
+    _add_column(Job.__table__, 'attempts', fill=0)
+
+
+# Schema changes since the first release by schema version, with
+# functions filling their derived data. Schema changes check what is
+# there already, so they also work on databases made by create_all of
+# any earlier version. Filling runs after all schema changes as it
+# uses the current models.
+MIGRATIONS = [
+    (1, 'search index', _search_index, rebuild_search_index),
+    (2, 'tag post counts and tag indexes', _tag_counts, recount_tags),
+    (3, 'post versions', _post_versions, None),
+    (4, 'post excerpts', _excerpts, rebuild_excerpts),
+    (5, 'job queue', _job_queue, None),
+    (6, 'job attempts', _job_attempts, None),
+    ]
+
+
+def schema_version():
+    """Return schema version of the database or None if not known."""
+    if ContentVersion.__tablename__ not in _inspector().get_table_names():
+        return None
+    row = ContentVersion.query.get('schema')
+    return row.version if row else None
+
+
+def _set_schema_version(version):
+    row = ContentVersion.query.get('schema')
+    if row is None:
+        db.session.add(ContentVersion('schema', version, utcnow()))
+    else:
+        row.version = version
+        row.updated = utcnow()
+
+
+def migrate(report=None):
+    """Create or update database schema and fill derived data.
+
+    Empty database gets the current schema. Others get migrations
+    newer than their schema version. Returns list of applied schema
+    versions.
+
+    Keyword arguments:
+    report -- called with version and description of each migration
+
+    """
+    tables = _inspector().get_table_names()
+    _create_table(ContentVersion.__table__)
+    db.session.commit()
+    current = schema_version()
+    if current is None and 'blogpost' not in tables:
+        db.create_all()
+        _set_schema_version(MIGRATIONS[-1][0])
+        db.session.commit()
+        return []
+    pending = [migration for migration in MIGRATIONS 
+               if migration[0] > (current or 0)]
+    for version, description, change, fill in pending:
+        if report:
+            report(version, description)
+        change()
+        db.session.commit()
+    for version, description, change, fill in pending:
+        if fill:
+            fill()
+    if pending:
+        _set_schema_version(pending[-1][0])
+        db.session.commit()
+    return [migration[0] for migration in pending]
+
+
+def _open(name, mode):
+    if name == '-':
+        return sys.stdout if 'w' in mode else sys.stdin
+    return open(name, mode)
+
+
+def command_export(args):
+    started = time.time()
+    out = _open(args.file, 'w')
+    count = export_posts(out, args.chunk_size)
+    out.flush()
+    _report(count, started)
+
+
+def command_import(args):
+    started = time.time()
+    import_posts(_open(args.file, 'r'), args.chunk_size, args.keep_ids,
+                 lambda count: _report(count, started))
+
+
+def command_jobs(args):
+    depth, lag = jobs.stats()
+    sys.stderr.write('%d jobs waiting, oldest %.1f s\n' % (depth, lag))
+    if not args.stats:
+        sys.stderr.write('%d jobs done\n' % jobs.run_pending())
+
+
+def command_build_assets(args):
+    build_assets(lambda name, size: sys.stderr.write(
+        '%s %d bytes\n' % (name, size)))
+
+
+def command_vendor_jquery(args):
+    vendor_jquery(args.version)
+    sys.stderr.write('jQuery %s written to static/js\n' % args.version)
+
+
+def command_export_site(args):
+    started = time.time()
+    written = export_site(args.directory, args.processes, 
+                          lambda count: sys.stderr.write(
+                              '%d files written\r' % count))
+    sys.stderr.write('%d files written in %.1f s\n' % 
+                     (written, time.time() - started))
+
+
+def command_migrate(args):
+    applied = migrate(lambda version, description: sys.stderr.write(
+        'applying %d: %s\n' % (version, description)))
+    sys.stderr.write('schema version %d, %d migrations applied\n' % 
+                     (schema_version(), len(applied)))
+
+
+def _report(count, started):
+    elapsed = max(time.time() - started, 0.001)
+    sys.stderr.write('%d posts in %.1f s, %.0f posts/s\n' %
+                     (count, elapsed, count / elapsed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage tagblog.')
+    parser.add_argument('--statement-timeout', type=int, default=0, 
+                        help='PostgreSQL statement timeout in '
+                        'milliseconds, default none')
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser(
+        'export', help='write posts with tag names as JSON lines')
+    command.add_argument('file', nargs='?', default='-',
+                         help='file to write, default stdout')
+    command.add_argument('--chunk-size', type=int, default=1000)
+    command.set_defaults(func=command_export)
+
+    command = commands.add_parser(
+        'import', help='add posts from JSON lines written by export')
+    command.add_argument('file', nargs='?', default='-',
+                         help='file to read, default stdin')
+    command.add_argument('--chunk-size', type=int, default=1000)
+    command.add_argument('--keep-ids', action='store_true',
+                         help='keep post ids of the file')
+    command.set_defaults(func=command_import)
+
+    command = commands.add_parser(
+        'build-assets', help='bundle, minify and compress static files')
+    command.set_defaults(func=command_build_assets)
+
+    command = commands.add_parser(
+        'vendor-jquery', help='download jQuery to static/js')
+    command.add_argument('--version', default=JQUERY_VERSION, 
+                         help='default %s' % JQUERY_VERSION)
+    command.set_defaults(func=command_vendor_jquery)
+
+    command = commands.add_parser(
+        'export-site', help='render pages as files for a plain web server')
+    command.add_argument('directory', 
+                         help='serve its subdirectory current')
+    command.add_argument('--processes', type=int, 
+                         help='rendering processes, default amount of cores')
+    command.set_defaults(func=command_export_site)
+
+    command = commands.add_parser(
+        'migrate', help='create or update database schema')
+    command.set_defaults(func=command_migrate)
+
+    command = commands.add_parser(
+        'jobs', help='do jobs waiting in the job queue')
+    command.add_argument('--stats', action='store_true',
+                         help='only show depth and lag of the queue')
+    command.set_defaults(func=command_jobs)
+
+    args = parser.parse_args(argv)
+    # Migrations and imports run statements longer than requests may,
+    # set before the engine is made
+    app.config['SQLALCHEMY_STATEMENT_TIMEOUT'] = args.statement_timeout
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
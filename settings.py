@@ -1,2 +1,18 @@
 import os
-SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///tagblog.db')
\ No newline at end of file
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///tagblog.db')
+# Read-only GET pages of anonymous users are served from the replica
+if os.environ.get('REPLICA_DATABASE_URL'):
+    SQLALCHEMY_BINDS = {'replica': os.environ['REPLICA_DATABASE_URL']}
+# Database pool is sized for waitress threads, keep this in sync with
+# --threads in Procfile
+WAITRESS_THREADS = int(os.environ.get('WAITRESS_THREADS', 4))
+SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 5))
+SQLALCHEMY_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+SQLALCHEMY_STATEMENT_TIMEOUT = int(
+    os.environ.get('DATABASE_STATEMENT_TIMEOUT', 30000))
+# Feeds are rebuilt by any web process, so with many processes or
+# hosts this must be storage shared by all of them
+if os.environ.get('FEED_DIR'):
+    FEED_DIR = os.environ['FEED_DIR']
+# Address of the site in feeds, which are built outside of requests
+SITE_URL = os.environ.get('SITE_URL', 'http://localhost/')
@@ -1,14 +1,41 @@
+import base64
+import bisect
+import gzip
+import hashlib
+import hmac
+import json
 import math
+import mimetypes
 import os
+import Queue
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from datetime import datetime
+from functools import partial, wraps
+from itertools import chain
 
 from flask import (Flask, render_template, Markup, 
-                    abort, redirect, url_for, request, flash)
+                    abort, redirect, url_for, request, flash, session, g, 
+                    has_request_context, send_file, get_flashed_messages, 
+                    stream_with_context, _request_ctx_stack)
+from flask.helpers import safe_join
 from flask.ext.wtf import Form
 from flask.ext.login import (LoginManager, current_user, login_required,
                             login_user, logout_user, UserMixin, AnonymousUser)
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import IntegrityError
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from jinja2 import Template
+from jinja2.filters import do_truncate
+from sqlalchemy import case, desc, event, func
+from sqlalchemy.exc import DisconnectionError, IntegrityError
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.sql.expression import UpdateBase
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+from werkzeug.security import check_password_hash
+from werkzeug.wsgi import ClosingIterator
 from wtforms import (TextField, PasswordField, TextAreaField, 
                     SelectMultipleField, HiddenField, FieldList, FormField)
 from wtforms.ext.sqlalchemy.orm import model_form
@@ -20,11 +47,469 @@ app = Flask(__name__)
 # This way we can change settings while testing.
 app.config.from_pyfile(os.environ.get('TAGBLOG_SETTINGS_FILE', 'settings.py'))
 app.secret_key = os.environ['SECRET_KEY']
-db = SQLAlchemy(app)
+
+
+class RoutingSession(_SignallingSession):
+    """Session reading from the replica bind when the request allows.
+
+    Views decorated with reads_from_replica set g.db_bind. Flushes and
+    insert, update and delete statements always go to the primary.
+
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        _SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if (has_request_context() and getattr(g, 'db_bind', None) and 
+                not self._flushing and not isinstance(clause, UpdateBase)):
+            return self.db.get_engine(self.app, bind=g.db_bind)
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+class TagblogSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with pool settings for server databases.
+
+    Pool of a server database is sized for the waitress threads
+    (WAITRESS_THREADS) and job workers unless SQLALCHEMY_POOL_SIZE is
+    set. Other settings:
+    SQLALCHEMY_MAX_OVERFLOW --- connections opened past pool size \
+    under load and closed after use, default 5
+    SQLALCHEMY_POOL_RECYCLE --- seconds after which connections are \
+    replaced, default 1800
+    SQLALCHEMY_PRE_PING --- test connections when taken from pool \
+    and replace dead ones, default True
+    SQLALCHEMY_STATEMENT_TIMEOUT --- PostgreSQL statement timeout \
+    in milliseconds, default none
+
+    """
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return scoped_session(partial(RoutingSession, self, **options), 
+                              scopefunc=scopefunc)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(TagblogSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername == 'sqlite':
+            return
+        options.setdefault('pool_size', 
+                           app.config.get('WAITRESS_THREADS', 4) + 
+                           app.config.get('JOB_WORKERS', 2))
+        options.setdefault('pool_recycle', 1800)
+        options['max_overflow'] = app.config.get('SQLALCHEMY_MAX_OVERFLOW', 5)
+        timeout = app.config.get('SQLALCHEMY_STATEMENT_TIMEOUT')
+        if timeout and info.drivername.startswith('postgresql'):
+            options.setdefault('connect_args', {})['options'] = (
+                '-c statement_timeout=%d' % timeout)
+
+    def get_engine(self, app, bind=None):
+        engine = super(TagblogSQLAlchemy, self).get_engine(app, bind)
+        if (app.config.get('SQLALCHEMY_PRE_PING', True) and 
+                engine.dialect.name != 'sqlite' and 
+                not getattr(engine, 'pre_ping', False)):
+            engine.pre_ping = True
+            event.listen(engine, 'checkout', _ping_connection)
+        return engine
+
+
+def _ping_connection(connection, record, proxy):
+    # Raising DisconnectionError makes the pool retry with a new
+    # connection, so requests never get a connection that died idle.
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+    except Exception:
+        raise DisconnectionError()
+
+
+db = TagblogSQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "index"
 
+# Amount of posts shown on one page
+POSTS_PER_PAGE = 10
+# Length of post excerpts shown on listing pages
+EXCERPT_LENGTH = 120
+
+
+class LRUCache(object):
+    """Thread-safe mapping evicting least recently used entries.
+
+    Entries also expire after timeout seconds unless timeout is None.
+
+    """
+    _missing = object()
+
+    def __init__(self, maxsize=1000, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return value of key or default if missing or expired."""
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        """Store value for key evicting the oldest entries if full."""
+        expires = None
+        if self.timeout is not None:
+            expires = time.time() + self.timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, create):
+        """Return value of key, storing create() first if missing."""
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            value = create()
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        """Remove key if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._data.clear()
+
+
+class CacheBackend(object):
+    """Storage interface of ResponseCache.
+
+    Entries depend on dependency tags like 'post:42' or 'listing'.
+    Invalidating a tag drops every entry depending on it.
+    Implement this to share cached pages between processes.
+
+    """
+
+    def get(self, key):
+        """Return value stored for key or None."""
+        raise NotImplementedError
+
+    def versions(self, tags):
+        """Return current versions of list of tags for set.
+
+        They are taken before the value is made, so invalidations made
+        meanwhile leave the stored value stale.
+
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, versions):
+        """Store value for key depending on versions of its tags."""
+        raise NotImplementedError
+
+    def invalidate(self, tags):
+        """Drop entries depending on any of tags."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Drop every entry."""
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Process local CacheBackend with LRU eviction and expiry.
+
+    Every tag has a version number. Entries remember versions of their
+    tags when stored and are stale once any of them has been bumped,
+    so invalidation does not need to find the entries.
+
+    """
+
+    def __init__(self, maxsize=1000, timeout=300):
+        self._entries = LRUCache(maxsize, timeout)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, versions = entry
+        for tag, version in versions:
+            if self._versions.get(tag, 0) != version:
+                self._entries.delete(key)
+                return None
+        return value
+
+    def versions(self, tags):
+        return tuple((tag, self._versions.get(tag, 0)) for tag in tags)
+
+    def set(self, key, value, versions):
+        self._entries.set(key, (value, versions))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def clear(self):
+        self._entries.clear()
+
+
+class ResponseCache(object):
+    """Cache of whole pages rendered for anonymous readers.
+
+    Enabled with RESPONSE_CACHE_ENABLED setting. Pages are keyed on
+    path and query string. Pages of logged in users, pages with
+    flashed messages and responses other than 200 are never cached.
+
+    """
+    _csrf_re = re.compile(r'(name="csrf_token" type="hidden" value=")[^"]*')
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def cached(self, *tags):
+        """Decorate view to cache its page.
+
+        Keyword arguments:
+        tags --- dependency tags of the page. They are formatted with \
+        keyword arguments of the view, for example 'post:{id}'.
+
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**kwargs):
+                if not self.cacheable():
+                    return view(**kwargs)
+                key = request.path + '?' + request.query_string
+                validators = getattr(g, 'page_validators', None)
+                page = self.backend.get(key)
+                if page is not None:
+                    response = app.response_class(self._fresh_csrf(page[0]), 
+                                                  mimetype=page[1])
+                    response.headers['X-Cache'] = 'HIT'
+                    if validators is not None:
+                        validators.set(page[2])
+                    return response
+                # Versions and validators must not be newer than the page
+                versions = self.backend.versions(
+                    [tag.format(**kwargs) for tag in tags])
+                if validators is not None:
+                    validators.get()
+                response = app.make_response(view(**kwargs))
+                if response.status_code == 200 and '_flashes' not in session:
+                    self.backend.set(key, 
+                                     (response.data, response.mimetype, 
+                                      validators and validators.get()), 
+                                     versions)
+                return response
+            return wrapper
+        return decorator
+
+    def invalidate(self, *tags):
+        """Drop cached pages depending on any of tags."""
+        self.backend.invalidate(tags)
+
+    def cacheable(self):
+        """Return True if the page of this request may be cached."""
+        return (app.config.get('RESPONSE_CACHE_ENABLED', False) and
+                request.method == 'GET' and 
+                not current_user.is_authenticated() and
+                '_flashes' not in session and 
+                not static_site())
+
+    def _fresh_csrf(self, page):
+        """Replace CSRF tokens of the cached page with our own."""
+        if not app.config.get('CSRF_ENABLED', True):
+            return page
+        token = str(LoginForm().csrf_token.current_token)
+        return self._csrf_re.sub(lambda m: m.group(1) + token, page)
+
+
+response_cache = ResponseCache(MemoryCacheBackend(
+    maxsize=app.config.get('RESPONSE_CACHE_SIZE', 1000),
+    timeout=app.config.get('RESPONSE_CACHE_TIMEOUT', 300)))
+
+# Total amount of posts and search results. Counting is a full scan
+# so we do it once in a while instead of every request.
+post_counts = LRUCache(timeout=app.config.get('COUNT_CACHE_TIMEOUT', 60))
+
+
+def make_password_hash(password, iterations=None):
+    """Return salted PBKDF2-SHA256 hash of password.
+
+    The hash is formatted like werkzeug hashes as
+    pbkdf2:sha256:<iterations>$<salt>$<hex digest>.
+
+    Keyword arguments:
+    password -- password to hash
+    iterations -- work factor, default PASSWORD_HASH_ITERATIONS setting
+
+    """
+    if iterations is None:
+        iterations = app.config.get('PASSWORD_HASH_ITERATIONS', 50000)
+    salt = os.urandom(8).encode('hex')
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'),
+                                 salt, iterations)
+    return 'pbkdf2:sha256:%d$%s$%s' % (iterations, salt, digest.encode('hex'))
+
+
+def check_password(pw_hash, password):
+    """Validate password against hash of make_password_hash.
+
+    Older werkzeug hashes are validated with werkzeug.
+
+    """
+    if not pw_hash.startswith('pbkdf2:'):
+        return check_password_hash(pw_hash, password)
+    try:
+        method, salt, expected = pw_hash.split('$', 2)
+        prefix, name, iterations = method.split(':')
+        digest = hashlib.pbkdf2_hmac(str(name), password.encode('utf-8'),
+                                     str(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest.encode('hex'), str(expected))
+
+
+def password_needs_rehash(pw_hash):
+    """Check if hash was made with other than the current work factor."""
+    return not pw_hash.startswith('pbkdf2:sha256:%d$' % app.config.get(
+        'PASSWORD_HASH_ITERATIONS', 50000))
+
+
+class ExecutorBusy(Exception):
+    """Raised when all workers of BoundedExecutor are taken."""
+
+
+class BoundedExecutor(object):
+    """Runs calls on a fixed amount of worker threads.
+
+    Callers wait for their call, but no more than workers calls run at
+    once however many request threads call. At most limit calls may be
+    running or waiting for a worker, later calls raise ExecutorBusy
+    immediately. Callers waiting longer than timeout seconds raise
+    ExecutorBusy too, the call is still run and counted until it ends.
+    Keep limit below the amount of request threads, so waiting callers
+    can not take all of them.
+
+    """
+
+    def __init__(self, workers=2, limit=2, timeout=10):
+        self.workers = workers
+        self.limit = limit
+        self.timeout = timeout
+        self._queue = Queue.Queue()
+        self._pending = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def call(self, func, *args):
+        """Run func(*args) on a worker and return or raise its result."""
+        if len(self._threads) < self.workers:
+            # Workers are started lazily so they are not lost in a fork
+            self._start()
+        with self._lock:
+            if self._pending >= self.limit:
+                raise ExecutorBusy()
+            self._pending += 1
+        done = threading.Event()
+        outcome = []
+        self._queue.put((func, args, outcome, done))
+        if not done.wait(self.timeout):
+            raise ExecutorBusy()
+        succeeded, value = outcome[0]
+        if not succeeded:
+            raise value
+        return value
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, outcome, done = self._queue.get()
+            try:
+                outcome.append((True, func(*args)))
+            except Exception, e:
+                outcome.append((False, e))
+            with self._lock:
+                self._pending -= 1
+            done.set()
+
+
+class LoginThrottle(object):
+    """Counts failed logins and blocks keys with too many of them.
+
+    Keys are blocked while they have limit failures within the last
+    window seconds.
+
+    """
+
+    def __init__(self, limit=5, window=300, maxsize=10000):
+        self.limit = limit
+        self.window = window
+        self._failures = LRUCache(maxsize, timeout=window)
+        self._lock = threading.Lock()
+
+    def _recent(self, key):
+        since = time.time() - self.window
+        return [at for at in self._failures.get(key, ()) if at > since]
+
+    def blocked(self, *keys):
+        """Check if any of keys has too many recent failures."""
+        return any(len(self._recent(key)) >= self.limit for key in keys)
+
+    def fail(self, *keys):
+        """Record failed login for every key."""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                recent = self._recent(key)[-(self.limit - 1):]
+                self._failures.set(key, recent + [now])
+
+    def reset(self, *keys):
+        """Forget failures of keys."""
+        for key in keys:
+            self._failures.delete(key)
+
+    def clear(self):
+        """Forget every failure."""
+        self._failures.clear()
+
+
+# Password hashing is slow on purpose. Run it on its own threads so a
+# burst of logins can not take every server thread from readers. By
+# default logins may hold half of the waitress threads.
+password_executor = BoundedExecutor(
+    workers=app.config.get('LOGIN_WORKERS', 2),
+    limit=app.config.get('LOGIN_BACKLOG', 
+                         max(app.config.get('WAITRESS_THREADS', 4) // 2, 1)),
+    timeout=app.config.get('LOGIN_TIMEOUT', 10))
+login_throttle = LoginThrottle(
+    limit=app.config.get('LOGIN_ATTEMPTS', 5),
+    window=app.config.get('LOGIN_ATTEMPT_WINDOW', 300))
+# Hash checked for unknown usernames so they take as long as known ones
+_dummy_hashes = LRUCache(maxsize=4)
+
 
 class User(db.Model):
     """Model for user of tagblog website."""
@@ -45,11 +530,12 @@ class User(db.Model):
 
     def set_password(self, password):
         """Save password hash."""
-        self._pw_hash = generate_password_hash(password)
+        self._pw_hash = make_password_hash(password)
+        user_cache.delete(self.id)
 
     def check_password(self, password):
         """Validate password against password hash."""
-        return check_password_hash(self._pw_hash, password)
+        return check_password(self._pw_hash, password)
 
     def is_authenticated(self):
         """Check if user has authenticated. 
@@ -85,10 +571,70 @@ class User(db.Model):
         return True
 
 
+class LoadedUser(object):
+    """Detached copy of User stored in user_cache.
+
+    Has what Flask-Login and templates use of User, but no password
+    hash and no session, so it can be shared between requests.
+
+    """
+    __slots__ = ('id', 'username', '_active', '_admin')
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self._active = user.is_active()
+        self._admin = user.is_admin()
+
+    def is_authenticated(self):
+        """Loaded user is always authenticated."""
+        return True
+
+    def is_active(self):
+        """Check if user was active when loaded."""
+        return self._active
+
+    def is_anonymous(self):
+        """Loaded user is never anonymous."""
+        return False
+
+    def get_id(self):
+        """Returns unique unicode id for the user."""
+        return unicode(self.id)
+
+    def is_admin(self):
+        """Check if user was admin when loaded."""
+        return self._admin
+
+
+# Users of logged in sessions by id. Entries are dropped when password
+# is set or user deleted and expire in case user was changed elsewhere.
+user_cache = LRUCache(maxsize=100,
+                      timeout=app.config.get('USER_CACHE_TIMEOUT', 60))
+
+
+@event.listens_for(User, 'after_delete')
+def _forget_user(mapper, connection, user):
+    user_cache.delete(user.id)
+
+
+def utcnow():
+    """Return current UTC time in HTTP date precision."""
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def make_excerpt(body):
+    """Return body shortened to listing pages like truncate filter."""
+    return do_truncate(body or u'', EXCERPT_LENGTH)
+
+
 # Helper table for tag-blogpost relationship
 tagsTable = db.Table('tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-    db.Column('blogpost_id', db.Integer, db.ForeignKey('blogpost.id'))
+    db.Column('blogpost_id', db.Integer, db.ForeignKey('blogpost.id'), 
+              index=True),
+    # Tag pages seek through posts of one tag by id
+    db.Index('ix_tags_tag_id_blogpost_id', 'tag_id', 'blogpost_id')
     )
 
 
@@ -96,6 +642,8 @@ class Tag(db.Model):
     """Model for tags"""
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True)
+    # Amount of posts having this tag. Kept up to date by writes.
+    post_count = db.Column(db.Integer, nullable=False, default=0)
 
     def __init__(self, name):
         self.name = name
@@ -113,7 +661,14 @@ class Blogpost(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(80))
     body = db.Column(db.Text)
-    tags = db.relationship('Tag', secondary=tagsTable, 
+    # Start of body for listing pages, so they need not load body.
+    # Kept up to date by _update_excerpt.
+    excerpt = db.Column(db.String(EXCERPT_LENGTH + 4))
+    # Bumped on every edit. Used for validating cached copies.
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated = db.Column(db.DateTime, nullable=False, default=utcnow)
+    # Ordered by name like PostRow tags, so both show the same page
+    tags = db.relationship('Tag', secondary=tagsTable, order_by='Tag.name', 
         backref=db.backref('blogposts', lazy='dynamic'))
 
     def __init__(self, title, body, tags=None):
@@ -134,9 +689,132 @@ class Blogpost(db.Model):
         """Add new tag to post."""
         self.tags.append(tag)
 
+    @db.validates('body')
+    def _update_excerpt(self, key, body):
+        self.excerpt = make_excerpt(body)
+        return body
+
+    def touch(self):
+        """Mark post modified."""
+        self.version = Blogpost.version + 1
+        self.updated = utcnow()
+
+    @classmethod
+    def listing(cls):
+        """Return query for listing pages.
+
+        Tags of all loaded posts are fetched in one extra query,
+        so a page of posts costs two queries whatever the page size.
+        Body is not loaded, listings show excerpt instead.
+
+        """
+        return cls.query.options(db.subqueryload(cls.tags), db.defer('body'))
 
-# Create database
-db.create_all()
+
+class Posting(db.Model):
+    """Model for search index postings.
+
+    One row per term per blogpost with the term frequency.
+    Primary key starts with term so that posting lists are index scans.
+
+    """
+    term = db.Column(db.String(80), primary_key=True)
+    blogpost_id = db.Column(db.Integer, db.ForeignKey('blogpost.id'),
+                            primary_key=True, index=True)
+    frequency = db.Column(db.Integer, nullable=False)
+
+
+class ContentVersion(db.Model):
+    """Model for counters bumped whenever content changes.
+
+    Counter 'listing' changes with any post and 'tags' with any tag.
+    Shared by all processes so cached copies can be validated anywhere.
+
+    """
+    name = db.Column(db.String(20), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, name, version, updated):
+        self.name = name
+        self.version = version
+        self.updated = updated
+
+
+class Job(db.Model):
+    """Model for derived data work waiting for JobQueue.
+
+    Rows are added in the transaction of the change needing the work
+    and deleted in the transaction doing it, so work is not lost if
+    the process dies in between. Failed attempts are counted and
+    jobs failing too many times are left parked in the table.
+
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    key = db.Column(db.Integer, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+
+def bump_versions(*names):
+    """Bump content version counters. Caller has to commit."""
+    now = utcnow()
+    for name in names:
+        updated = (ContentVersion.query.filter_by(name=name)
+                   .update({'version': ContentVersion.version + 1, 
+                            'updated': now}, 
+                           synchronize_session=False))
+        if not updated:
+            db.session.add(ContentVersion(name, 1, now))
+
+
+def content_versions():
+    """Return dictionary of name to (version, updated) of counters."""
+    return dict((row.name, (row.version, row.updated)) 
+                for row in db.session.query(ContentVersion.name, 
+                                            ContentVersion.version, 
+                                            ContentVersion.updated))
+
+
+def adjust_tag_counts(added=(), removed=()):
+    """Update post counts of tags. Caller has to commit.
+
+    Keyword arguments:
+    added -- ids of tags added to a post
+    removed -- ids of tags removed from a post
+
+    """
+    for ids, change in ((added, 1), (removed, -1)):
+        if ids:
+            Tag.query.filter(Tag.id.in_(list(ids))).update(
+                {'post_count': Tag.post_count + change}, 
+                synchronize_session=False)
+
+
+def recount_tags(ids=None):
+    """Recount post counts of tags from scratch and commit.
+
+    Writes change counts by one, this is for repairing them.
+
+    Keyword arguments:
+    ids -- ids of tags to recount, all tags by default
+
+    """
+    if ids is None:
+        db.session.execute(_recount_tags())
+    else:
+        for chunk in chunks(list(ids)):
+            db.session.execute(_recount_tags()
+                               .where(Tag.__table__.c.id.in_(chunk)))
+    db.session.commit()
+
+
+def _recount_tags():
+    return Tag.__table__.update().values(
+        post_count=db.select([func.count()])
+        .where(tagsTable.c.tag_id == Tag.__table__.c.id)
+        .as_scalar())
 
 
 @login_manager.user_loader
@@ -148,9 +826,71 @@ def load_user(userid):
 
     """
     try:
-        return User.query.filter_by(id=int(userid)).first()
-    except Exception, e:
+        id = int(userid)
+    except (TypeError, ValueError):
         return None
+    user = user_cache.get(id)
+    if user is None:
+        user = User.query.get(id)
+        if user is None:
+            return None
+        user = LoadedUser(user)
+        user_cache.set(id, user)
+    return user
+
+
+class TagChoices(object):
+    """Process-wide cache of (id, name) choices of all tags.
+
+    Shared by every request and thread. Writers call invalidate()
+    which bumps the version, so a list loaded while tags were
+    changing is never stored. Tags changed by other processes are
+    noticed by the 'tags' content version, which is checked at most
+    every check_interval seconds.
+
+    """
+
+    def __init__(self, check_interval=5):
+        self.version = 0
+        self.check_interval = check_interval
+        # (choices, 'tags' content version, time of check)
+        self._cached = None
+        self._lock = threading.Lock()
+
+    def get(self, fresh=False):
+        """Return tuple of (id, name) of all tags ordered by name.
+
+        Keyword arguments:
+        fresh --- check the 'tags' content version now
+
+        """
+        version = self.version
+        cached = self._cached
+        now = time.time()
+        if (cached is not None and not fresh and 
+                now - cached[2] < self.check_interval):
+            return cached[0]
+        tags = (db.session.query(ContentVersion.version)
+                .filter_by(name='tags').scalar())
+        if cached is not None and cached[1] == tags:
+            choices = cached[0]
+        else:
+            choices = tuple(db.session.query(Tag.id, Tag.name)
+                            .order_by(Tag.name))
+        with self._lock:
+            if self.version == version:
+                self._cached = (choices, tags, now)
+        return choices
+
+    def invalidate(self):
+        """Forget cached choices."""
+        with self._lock:
+            self.version += 1
+            self._cached = None
+
+
+tag_choices = TagChoices(
+    check_interval=app.config.get('TAG_CHOICES_CHECK_INTERVAL', 5))
 
 
 class LoginForm(Form):
@@ -198,9 +938,16 @@ class BlogpostForm(Form):
             self.tags.data = [t.id for t in post.tags]
 
     def post_init(self):
-        """Update possible tags."""
-        self.tags.choices = [(t.id, t.name) 
-                            for t in Tag.query.order_by('name').all()]
+        """Update possible tags.
+
+        Tags posted from a form of another process may be missing from
+        cached choices, then they are checked again.
+
+        """
+        choices = tag_choices.get()
+        if set(self.tags.data or ()) - set(id for id, name in choices):
+            choices = tag_choices.get(fresh=True)
+        self.tags.choices = choices
 
 
 class SingleTagForm(Form):
@@ -214,6 +961,1570 @@ class TagForm(Form):
     tags = FieldList(FormField(SingleTagForm))
 
 
+class Histogram(object):
+    """Prometheus style histogram of observed values."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Add value to the histogram."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class TimedTemplate(Template):
+    """Template reporting its render time to instrumentation."""
+
+    def render(self, *args, **kwargs):
+        if not instrumentation.enabled:
+            return Template.render(self, *args, **kwargs)
+        started = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            instrumentation.observe_part('render', 'template', self.name, 
+                                         time.time() - started)
+
+    def generate(self, *args, **kwargs):
+        if not instrumentation.enabled:
+            return Template.generate(self, *args, **kwargs)
+        return self._timed(Template.generate(self, *args, **kwargs))
+
+    def _timed(self, parts):
+        # Only time spent rendering counts, not time spent sending
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.time()
+                try:
+                    part = next(parts)
+                finally:
+                    elapsed += time.time() - started
+                yield part
+        except StopIteration:
+            instrumentation.observe_part('render', 'template', self.name, 
+                                         elapsed)
+
+
+class Instrumentation(object):
+    """Opt-in per endpoint timing of SQL, templates and forms.
+
+    Enabled with INSTRUMENTATION_ENABLED setting. Histograms are served
+    in Prometheus text format at /metrics and, with SERVER_TIMING
+    setting, request totals are sent in a Server-Timing header. For
+    streamed pages (index, search and post) the header is sent before
+    the page is rendered, so it leaves out rendering and the queries
+    done during it. Histograms include them.
+    Nothing is hooked until enabled and hooks only check a flag
+    when disabled again.
+
+    """
+    TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 
+                    1.0, 2.5, 5.0, 10.0)
+    COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+    HELP = {
+        'tagblog_request_seconds': 'Request duration by endpoint.',
+        'tagblog_request_sql_statements': 'SQL statements per request.',
+        'tagblog_request_sql_seconds': 'SQL time per request.',
+        'tagblog_template_render_seconds': 'Render time by template.',
+        'tagblog_form_construct_seconds': 'Construction time by form.',
+        }
+
+    def __init__(self):
+        self.enabled = False
+        self._installed = False
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """Start recording."""
+        with self._lock:
+            if not self._installed:
+                self._install()
+                self._installed = True
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording."""
+        self.enabled = False
+
+    def reset(self):
+        """Forget recorded values."""
+        with self._lock:
+            self._histograms.clear()
+
+    def _install(self):
+        event.listen(db.engine, 'before_cursor_execute', 
+                     self._before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', 
+                     self._after_cursor_execute)
+        app.jinja_env.template_class = TimedTemplate
+        app.jinja_env.cache.clear()
+        for form in (LoginForm, BlogpostForm, TagForm):
+            self._time_form(form)
+
+    def _time_form(self, form):
+        init = form.__init__
+        name = form.__name__
+        @wraps(init)
+        def timed_init(*args, **kwargs):
+            if not self.enabled:
+                return init(*args, **kwargs)
+            started = time.time()
+            try:
+                init(*args, **kwargs)
+            finally:
+                self.observe_part('forms', 'form', name, 
+                                  time.time() - started)
+        form.__init__ = timed_init
+
+    def _before_cursor_execute(self, conn, cursor, statement, 
+                               parameters, context, executemany):
+        if self.enabled:
+            conn.info.setdefault('query_started', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, 
+                              parameters, context, executemany):
+        started = conn.info.get('query_started')
+        if not started:
+            return
+        elapsed = time.time() - started.pop()
+        if self.enabled and has_request_context():
+            timings = getattr(g, 'timings', None)
+            if timings is not None:
+                timings['sql'] += elapsed
+                timings['statements'] += 1
+
+    def observe(self, name, labels, value):
+        """Add value to histogram name with dictionary of labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(
+                    self.COUNT_BUCKETS if name.endswith('_statements') 
+                    else self.TIME_BUCKETS)
+            histogram.observe(value)
+
+    def observe_part(self, part, label, name, elapsed):
+        """Record time spent on a template or form."""
+        self.observe('tagblog_%s_seconds' % 
+                     {'render': 'template_render', 
+                      'forms': 'form_construct'}[part], 
+                     {label: name}, elapsed)
+        if not has_request_context():
+            return
+        timings = getattr(g, 'timings', None)
+        if timings is not None:
+            timings[part] += elapsed
+
+    def before_request(self):
+        if self.enabled:
+            g.timings = {'started': time.time(), 'sql': 0.0, 
+                         'statements': 0, 'render': 0.0, 'forms': 0.0}
+
+    def after_request(self, response):
+        """Record request histograms when the response is closed.
+
+        Streamed pages are rendered after this, so their histograms
+        are recorded on close to include rendering and its queries.
+        Server-Timing header is sent before that and can not include
+        time spent on the streamed body.
+
+        """
+        timings = getattr(g, 'timings', None)
+        if timings is None:
+            return response
+        labels = {'endpoint': request.endpoint or 'unknown'}
+        def record():
+            self.observe('tagblog_request_seconds', labels, 
+                         time.time() - timings['started'])
+            self.observe('tagblog_request_sql_statements', labels, 
+                         timings['statements'])
+            self.observe('tagblog_request_sql_seconds', labels, 
+                         timings['sql'])
+        response.call_on_close(record)
+        if app.config.get('SERVER_TIMING', False):
+            response.headers['Server-Timing'] = ', '.join([
+                'sql;dur=%.2f;desc="%d statements"' % 
+                (timings['sql'] * 1000, timings['statements']), 
+                'render;dur=%.2f' % (timings['render'] * 1000), 
+                'forms;dur=%.2f' % (timings['forms'] * 1000)])
+        return response
+
+    def exposition(self):
+        """Return recorded histograms in Prometheus text format."""
+        with self._lock:
+            histograms = sorted((key, (h.buckets, list(h.counts), h.sum)) 
+                                for key, h in self._histograms.items())
+        lines = []
+        described = set()
+        for (name, labels), (buckets, counts, total) in histograms:
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, self.HELP[name]))
+                lines.append('# TYPE %s histogram' % name)
+            labels = ','.join('%s="%s"' % (key, value.replace('\\', '\\\\')
+                                           .replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                              for key, value in labels)
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % 
+                             (name, labels, bound, cumulative))
+            lines.append('%s_sum{%s} %r' % (name, labels, total))
+            lines.append('%s_count{%s} %d' % (name, labels, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+instrumentation = Instrumentation()
+app.before_request(instrumentation.before_request)
+app.after_request(instrumentation.after_request)
+if app.config.get('INSTRUMENTATION_ENABLED', False):
+    instrumentation.enable()
+
+
+# Content types worth compressing
+COMPRESSED_MIMETYPES = frozenset([
+    'text/html', 'text/plain', 'text/css', 'text/xml', 'application/json', 
+    'application/javascript', 'application/xml', 'application/atom+xml'])
+
+
+class GzipMiddleware(object):
+    """WSGI middleware compressing responses for clients accepting gzip.
+
+    Responses are compressed while they are sent, so streamed pages
+    stay streamed. Responses shorter than minimum_size, of other content
+    types or already encoded are passed as they are. Length of streamed
+    responses is unknown, so they are buffered until minimum_size.
+
+    Keyword arguments:
+    app --- WSGI application to wrap
+    minimum_size --- smallest response body to compress in bytes
+    level --- zlib compression level
+    mimetypes --- content types to compress
+
+    """
+
+    def __init__(self, app, minimum_size=1024, level=6, 
+                 mimetypes=COMPRESSED_MIMETYPES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.mimetypes = mimetypes
+
+    def __call__(self, environ, start_response):
+        if (environ['REQUEST_METHOD'] == 'HEAD' or 
+                not parse_accept_header(
+                    environ.get('HTTP_ACCEPT_ENCODING'))['gzip']):
+            return self.app(environ, start_response)
+        started = []
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            started[:] = [status, headers, exc_info]
+            return written.append
+
+        body = self.app(environ, capture)
+        status, headers, exc_info = started
+        headers = Headers(headers)
+        length = headers.get('Content-Length', type=int)
+        head = written
+        if self._compressible(status, headers) and length is None:
+            # Read far enough to know if the response is long enough
+            body = iter(body)
+            size = sum(len(part) for part in head)
+            for part in body:
+                head.append(part)
+                size += len(part)
+                if size >= self.minimum_size:
+                    break
+            else:
+                length = size
+                headers['Content-Length'] = str(size)
+        if (not self._compressible(status, headers) or 
+                (length is not None and length < self.minimum_size)):
+            start_response(status, headers.to_list(), exc_info)
+            return ClosingIterator(chain(head, body), 
+                                   getattr(body, 'close', None))
+        headers.pop('Content-Length', None)
+        headers['Content-Encoding'] = 'gzip'
+        vary = headers.get('Vary')
+        headers['Vary'] = vary + ', Accept-Encoding' if vary else \
+                          'Accept-Encoding'
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            # Compressed body is not byte for byte the same
+            headers['ETag'] = 'W/' + etag
+        start_response(status, headers.to_list(), exc_info)
+        return ClosingIterator(self._compress(chain(head, body)), 
+                               getattr(body, 'close', None))
+
+    def _compressible(self, status, headers):
+        code = int(status.split(None, 1)[0])
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        return (200 <= code < 300 and code != 204 and 
+                'Content-Encoding' not in headers and 
+                mimetype in self.mimetypes)
+
+    def _compress(self, parts):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 
+                                      16 + zlib.MAX_WBITS)
+        for part in parts:
+            # Flush every part so that streamed pages are not held back
+            data = (compressor.compress(part) + 
+                    compressor.flush(zlib.Z_SYNC_FLUSH))
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+if app.config.get('GZIP_ENABLED', True):
+    app.wsgi_app = GzipMiddleware(app.wsgi_app, 
+                                  app.config.get('GZIP_MIN_SIZE', 1024), 
+                                  app.config.get('GZIP_LEVEL', 6))
+
+
+# Words in title count this many times the words in body.
+TITLE_WEIGHT = 3
+_token_re = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return list of lowercase search terms in text."""
+    if not text:
+        return []
+    return [t[:80] for t in _token_re.findall(text.lower())]
+
+
+def index_post(post):
+    """Replace search index postings of the post.
+
+    Caller has to commit the session.
+
+    """
+    unindex_post(post.id)
+    rows = postings(post.id, post.title, post.body)
+    if rows:
+        db.session.execute(Posting.__table__.insert(), rows)
+
+
+def postings(post_id, title, body):
+    """Return list of posting rows for a post."""
+    counts = Counter(tokenize(body))
+    for term in tokenize(title):
+        counts[term] += TITLE_WEIGHT
+    return [{'term': term, 'blogpost_id': post_id, 'frequency': frequency}
+            for term, frequency in counts.iteritems()]
+
+
+def unindex_post(post_id):
+    """Remove search index postings of the post."""
+    db.session.execute(Posting.__table__.delete()
+                       .where(Posting.blogpost_id == post_id))
+
+
+def rebuild_search_index():
+    """Index every blogpost from scratch.
+
+    Needed once for posts written before the search index existed.
+
+    """
+    db.session.execute(Posting.__table__.delete())
+    for post in Blogpost.query.yield_per(1000):
+        index_post(post)
+    db.session.commit()
+
+
+def rebuild_excerpts():
+    """Compute excerpt of every blogpost.
+
+    Needed once for posts written before excerpts existed.
+
+    """
+    post = Blogpost.__table__
+    last = 0
+    while True:
+        rows = db.session.execute(
+            db.select([post.c.id, post.c.body])
+            .where(post.c.id > last)
+            .order_by(post.c.id)
+            .limit(1000)).fetchall()
+        if not rows:
+            break
+        last = rows[-1].id
+        db.session.execute(
+            post.update()
+            .where(post.c.id == db.bindparam('post_id'))
+            .values(excerpt=db.bindparam('excerpt')),
+            [{'post_id': row.id, 'excerpt': make_excerpt(row.body)}
+             for row in rows])
+    db.session.commit()
+
+
+def search_query(terms):
+    """Return (query, score) for posts containing every term.
+
+    The query yields blogpost ids ordered best match first and
+    score is the relevance expression it is ordered by.
+    Rarer terms weight more. Everything is done in one grouped query
+    driven by the posting list of the rarest term.
+    Returns None if nothing can match.
+
+    Keyword arguments:
+    terms -- list of search terms as returned by tokenize
+
+    """
+    terms = set(terms)
+    if not terms:
+        return None
+    frequencies = dict(db.session.query(Posting.term, func.count())
+                       .filter(Posting.term.in_(terms))
+                       .group_by(Posting.term))
+    if len(frequencies) < len(terms):
+        # Some term matches nothing so intersection is empty.
+        return None
+    most = max(frequencies.values())
+    weights = dict((term, int(1000 * (1 + math.log(float(most) / count))))
+                   for term, count in frequencies.iteritems())
+    rarest = min(frequencies, key=frequencies.get)
+    score = func.sum(Posting.frequency *
+                     case([(Posting.term == term, weight)
+                           for term, weight in weights.iteritems()]))
+    query = (db.session.query(Posting.blogpost_id, score)
+             .filter(Posting.term.in_(terms))
+             .filter(Posting.blogpost_id.in_(
+                 db.session.query(Posting.blogpost_id)
+                 .filter(Posting.term == rarest)))
+             .group_by(Posting.blogpost_id)
+             .having(func.count() == len(terms)))
+    return query, score
+
+
+def search_posts(terms):
+    """Return ids of posts containing every term, best match first."""
+    ranked = search_query(terms)
+    if ranked is None:
+        return []
+    query, score = ranked
+    return [row[0] for row in
+            query.order_by(desc(score), Posting.blogpost_id)]
+
+
+# Highlighted snippets of search results by (post id, version, terms)
+snippet_cache = LRUCache(maxsize=app.config.get('SNIPPET_CACHE_SIZE', 5000))
+# Compiled patterns matching any of terms by sorted terms
+_snippet_patterns = LRUCache(maxsize=100)
+
+
+def snippet_pattern(terms):
+    """Return compiled pattern matching any of terms as whole words."""
+    key = tuple(sorted(set(terms)))
+    return _snippet_patterns.get_or_create(key, lambda: re.compile(
+        r'(?<!\w)(?:%s)(?!\w)' % '|'.join(
+            re.escape(term) for term in sorted(key, key=len, reverse=True)),
+        re.IGNORECASE | re.UNICODE))
+
+
+def highlight(text, pattern, width=EXCERPT_LENGTH):
+    """Return Markup of part of text around matches of pattern.
+
+    Matches are found in one scan of the text. The window of width
+    characters with most different terms, and then most matches, is
+    shown with the matches in strong tags. Text without matches is
+    shortened like excerpts.
+
+    Keyword arguments:
+    text -- text to show part of
+    pattern -- compiled pattern from snippet_pattern
+    width -- approximate length of the snippet
+
+    """
+    text = text or u''
+    matches = [(m.start(), m.end(), m.group().lower())
+               for m in pattern.finditer(text)]
+    if not matches:
+        return Markup.escape(make_excerpt(text))
+    # Slide a window over the matches keeping count of terms in it
+    seen = Counter()
+    best = (0, 0, 0, 0)
+    first = 0
+    for last, (start, end, term) in enumerate(matches):
+        seen[term] += 1
+        while first < last and end - matches[first][0] > width:
+            seen[matches[first][2]] -= 1
+            if not seen[matches[first][2]]:
+                del seen[matches[first][2]]
+            first += 1
+        if (len(seen), last - first) > best[:2]:
+            best = (len(seen), last - first, first, last)
+    matches = matches[best[2]:best[3] + 1]
+    span_start, span_end = matches[0][0], matches[-1][1]
+    start = max(0, min(span_start - (width - (span_end - span_start)) // 2,
+                       len(text) - width))
+    end = min(len(text), max(start + width, span_end))
+    # Do not cut words in half
+    if start > 0:
+        start = text.find(u' ', start, span_start) + 1 or start
+    if end < len(text):
+        space = text.rfind(u' ', span_end, end)
+        if space != -1:
+            end = space
+    parts = [Markup(u'... ')] if start > 0 else []
+    position = start
+    for match_start, match_end, term in matches:
+        parts.append(Markup.escape(text[position:match_start]))
+        parts.append(Markup(u'<strong>%s</strong>') %
+                     text[match_start:match_end])
+        position = match_end
+    parts.append(Markup.escape(text[position:end]))
+    if end < len(text):
+        parts.append(Markup(u' ...'))
+    return Markup(u'').join(parts)
+
+
+def search_snippets(posts, terms):
+    """Return dictionary of post id to highlighted snippet of its body.
+
+    Bodies are loaded in one query, and only of posts without snippet
+    in snippet_cache.
+
+    Keyword arguments:
+    posts -- Blogpost objects, their bodies need not be loaded
+    terms -- search terms to highlight
+
+    """
+    terms = tuple(sorted(set(terms)))
+    snippets = {}
+    missing = []
+    for post in posts:
+        snippet = snippet_cache.get((post.id, post.version, terms))
+        if snippet is None:
+            missing.append(post)
+        else:
+            snippets[post.id] = snippet
+    if missing:
+        pattern = snippet_pattern(terms)
+        bodies = dict(db.session.query(Blogpost.id, Blogpost.body)
+                      .filter(Blogpost.id.in_([p.id for p in missing])))
+        for post in missing:
+            snippet = highlight(bodies.get(post.id), pattern)
+            snippet_cache.set((post.id, post.version, terms), snippet)
+            snippets[post.id] = snippet
+    return snippets
+
+
+def encode_cursor(*values):
+    """Return opaque url-safe token for integer values."""
+    return base64.urlsafe_b64encode(
+        ':'.join(str(v) for v in values)).rstrip('=')
+
+
+def decode_cursor(token, length):
+    """Return tuple of length integers encoded in token or None."""
+    try:
+        token = str(token)
+        token += '=' * (-len(token) % 4)
+        values = tuple(int(v) for v in
+                       base64.urlsafe_b64decode(token).split(':'))
+    except (TypeError, ValueError):
+        return None
+    if len(values) != length or values[0] < 1:
+        return None
+    return values
+
+
+def read_cursor(length):
+    """Return (page, after, before) from cursor tokens of the request.
+
+    Cursors are passed as 'after' or 'before' values and hold the page
+    number followed by length key values. Missing cursor means first
+    page. after and before are tuples of key values or None.
+
+    """
+    for name in ('after', 'before'):
+        if name in request.values:
+            values = decode_cursor(request.values[name], length + 1)
+            if values:
+                if name == 'after':
+                    return values[0], values[1:], None
+                return values[0], None, values[1:]
+    return 1, None, None
+
+
+def keyset_page(query, after=None, before=None):
+    """Return (posts, has_prev, has_next) for page of posts by id.
+
+    Seeks past the cursor through the primary key instead of skipping
+    rows with offset, so every page costs the same.
+
+    Keyword arguments:
+    query --- Blogpost query to paginate
+    after --- id of the last post of previous page
+    before --- id of the first post of next page
+
+    """
+    if before is not None:
+        posts = (query.filter(Blogpost.id < before)
+                 .order_by(Blogpost.id.desc())
+                 .limit(POSTS_PER_PAGE+1).all())
+        has_prev = len(posts) > POSTS_PER_PAGE
+        return posts[:POSTS_PER_PAGE][::-1], has_prev, True
+    if after is not None:
+        query = query.filter(Blogpost.id > after)
+    posts = query.order_by(Blogpost.id).limit(POSTS_PER_PAGE+1).all()
+    has_next = len(posts) > POSTS_PER_PAGE
+    return posts[:POSTS_PER_PAGE], after is not None, has_next
+
+
+class TagRow(object):
+    """Read-only tag of a post loaded by post_rows."""
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class PostRow(object):
+    """Read-only post loaded by post_rows.
+
+    Has the attributes of Blogpost that templates use, so pages of
+    anonymous users can skip the identity map and change tracking of
+    the session. Body is there only if it was selected.
+
+    """
+    __slots__ = ('id', 'title', 'excerpt', 'version', 'body', 'tags')
+
+    def __init__(self, row, tags):
+        self.id = row.id
+        self.title = row.title
+        self.excerpt = row.excerpt
+        self.version = row.version
+        self.body = row.body if 'body' in row.keys() else None
+        self.tags = tags
+
+
+def slim_reads():
+    """Return True if the page may show PostRows instead of Blogposts.
+
+    Logged in users get Blogposts, as they may edit them.
+
+    """
+    return (app.config.get('SLIM_READS', True) and 
+            not current_user.is_authenticated())
+
+
+def post_select(body=False):
+    """Return Core select of the post columns of PostRow."""
+    post = Blogpost.__table__
+    columns = [post.c.id, post.c.title, post.c.excerpt, post.c.version]
+    if body:
+        columns.append(post.c.body)
+    return db.select(columns)
+
+
+def post_rows(select):
+    """Return list of PostRows of select from post_select.
+
+    Tags of all posts are loaded in one extra query.
+
+    """
+    rows = db.session.execute(select).fetchall()
+    if not rows:
+        return []
+    tag = Tag.__table__
+    tags = {}
+    for chunk in chunks([row.id for row in rows]):
+        for blogpost_id, id, name in db.session.execute(
+                db.select([tagsTable.c.blogpost_id, tag.c.id, tag.c.name], 
+                          tagsTable.c.tag_id == tag.c.id)
+                .where(tagsTable.c.blogpost_id.in_(chunk))
+                .order_by(tag.c.name)):
+            tags.setdefault(blogpost_id, []).append(TagRow(id, name))
+    return [PostRow(row, tags.get(row.id, [])) for row in rows]
+
+
+def keyset_rows(select, after=None, before=None):
+    """Return (posts, has_prev, has_next) like keyset_page, of PostRows.
+
+    Keyword arguments:
+    select --- select from post_select to paginate
+    after --- id of the last post of previous page
+    before --- id of the first post of next page
+
+    """
+    id = Blogpost.__table__.c.id
+    if before is not None:
+        posts = post_rows(select.where(id < before)
+                          .order_by(id.desc())
+                          .limit(POSTS_PER_PAGE+1))
+        has_prev = len(posts) > POSTS_PER_PAGE
+        return posts[:POSTS_PER_PAGE][::-1], has_prev, True
+    if after is not None:
+        select = select.where(id > after)
+    posts = post_rows(select.order_by(id).limit(POSTS_PER_PAGE+1))
+    has_next = len(posts) > POSTS_PER_PAGE
+    return posts[:POSTS_PER_PAGE], after is not None, has_next
+
+
+def count_pages(count):
+    """Return amount of pages needed for count posts."""
+    return int(math.ceil(float(count)/POSTS_PER_PAGE))
+
+
+def listing_cursors(page, posts, has_prev, has_next):
+    """Return (prev_cursor, next_cursor) for page of posts by id."""
+    prev_cursor = next_cursor = None
+    if posts and has_prev:
+        prev_cursor = encode_cursor(page-1, posts[0].id)
+    if posts and has_next:
+        next_cursor = encode_cursor(page+1, posts[-1].id)
+    return prev_cursor, next_cursor
+
+
+def ranked_page(ranked, score):
+    """Return (page, posts, prev_cursor, next_cursor) of search results.
+
+    Seeks past the (score, id) cursor of the request. Order is score
+    descending, id ascending.
+
+    Keyword arguments:
+    ranked --- query as returned by search_query
+    score --- score expression as returned by search_query
+
+    """
+    page, after, before = read_cursor(2)
+    if before is not None:
+        rows = (ranked.having((score > before[0]) | 
+                              ((score == before[0]) & 
+                               (Posting.blogpost_id < before[1])))
+                .order_by(score, desc(Posting.blogpost_id))
+                .limit(POSTS_PER_PAGE+1).all())
+        has_prev, has_next = len(rows) > POSTS_PER_PAGE, True
+        rows = rows[:POSTS_PER_PAGE][::-1]
+    else:
+        if after is not None:
+            ranked = ranked.having((score < after[0]) | 
+                                   ((score == after[0]) & 
+                                    (Posting.blogpost_id > after[1])))
+        rows = (ranked.order_by(desc(score), Posting.blogpost_id)
+                .limit(POSTS_PER_PAGE+1).all())
+        has_prev, has_next = after is not None, len(rows) > POSTS_PER_PAGE
+        rows = rows[:POSTS_PER_PAGE]
+    if not rows:
+        return page, [], None, None
+    posts = listed_posts([row[0] for row in rows])
+    prev_cursor = next_cursor = None
+    if has_prev:
+        prev_cursor = encode_cursor(page-1, rows[0][1], rows[0][0])
+    if has_next:
+        next_cursor = encode_cursor(page+1, rows[-1][1], rows[-1][0])
+    return page, posts, prev_cursor, next_cursor
+
+
+def listed_posts(ids):
+    """Return posts of ids for listing pages in order of ids."""
+    if not ids:
+        return []
+    if slim_reads():
+        found = post_rows(post_select()
+                          .where(Blogpost.__table__.c.id.in_(ids)))
+    else:
+        found = Blogpost.listing().filter(Blogpost.id.in_(ids))
+    found = dict((p.id, p) for p in found)
+    return [found[id] for id in ids if id in found]
+
+
+# Ordered search results by normalized terms and tag filter
+search_results = LRUCache(
+    maxsize=app.config.get('SEARCH_CACHE_SIZE', 500),
+    timeout=app.config.get('SEARCH_CACHE_TIMEOUT', 300))
+
+
+def cached_search(terms, clauses, filtered):
+    """Return list of (-score, post id) of search results, best first.
+
+    The whole list is cached by terms and tag filter, so every page
+    of it costs no search queries. Returns None if there are more than
+    SEARCH_CACHE_MAX_RESULTS results, those are paged by ranked_page.
+
+    Keyword arguments:
+    terms --- search terms from tokenize
+    clauses --- tag filter from parse_tag_filter
+    filtered --- tag_filter_query of clauses or None
+
+    """
+    key = (tuple(sorted(set(terms))), filter_key(clauses))
+    return search_results.get_or_create(
+        key, lambda: _search_results(terms, filtered))
+
+
+def _search_results(terms, filtered):
+    ranked = search_query(terms)
+    if ranked is None:
+        return []
+    query, score = ranked
+    if filtered is not None:
+        query = query.filter(Posting.blogpost_id.in_(filtered))
+    limit = app.config.get('SEARCH_CACHE_MAX_RESULTS', 10000)
+    rows = (query.order_by(desc(score), Posting.blogpost_id)
+            .limit(limit+1).all())
+    if len(rows) > limit:
+        return None
+    return [(-score, id) for id, score in rows]
+
+
+def results_page(results):
+    """Return (page, posts, prev_cursor, next_cursor) of cached results.
+
+    Cursors are the same as of ranked_page.
+
+    Keyword arguments:
+    results --- list as returned by cached_search
+
+    """
+    page, after, before = read_cursor(2)
+    if before is not None:
+        end = bisect.bisect_left(results, (-before[0], before[1]))
+        start = max(end - POSTS_PER_PAGE, 0)
+    else:
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(results, (-after[0], after[1]))
+        end = start + POSTS_PER_PAGE
+    rows = results[start:end]
+    if not rows:
+        return page, [], None, None
+    posts = listed_posts([id for score, id in rows])
+    prev_cursor = next_cursor = None
+    if start > 0:
+        prev_cursor = encode_cursor(page-1, -rows[0][0], rows[0][1])
+    if end < len(results):
+        next_cursor = encode_cursor(page+1, -rows[-1][0], rows[-1][1])
+    return page, posts, prev_cursor, next_cursor
+
+
+_filter_token_re = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def parse_tag_filter(text):
+    """Parse tag filter like 'python AND performance NOT draft'.
+
+    Terms are tag names, in double quotes if they contain spaces.
+    Adjacent terms are combined with AND, which binds tighter than OR.
+    NOT negates the next term.
+    Returns list of (include, exclude) frozensets of tag names,
+    one for each clause combined with OR.
+
+    """
+    clauses = []
+    include, exclude = set(), set()
+    negate = False
+    for match in _filter_token_re.finditer(text or u''):
+        name = match.group(1)
+        if name is None:
+            name = match.group(2)
+            keyword = name.upper()
+            if keyword == 'AND':
+                continue
+            if keyword == 'NOT':
+                negate = not negate
+                continue
+            if keyword == 'OR':
+                if include or exclude:
+                    clauses.append((frozenset(include), frozenset(exclude)))
+                include, exclude = set(), set()
+                negate = False
+                continue
+        if name:
+            (exclude if negate else include).add(name)
+        negate = False
+    if include or exclude:
+        clauses.append((frozenset(include), frozenset(exclude)))
+    # Clause both requiring and excluding a tag matches nothing
+    return [clause for clause in clauses if not clause[0] & clause[1]]
+
+
+def filter_key(clauses):
+    """Return hashable normalized form of parsed tag filter."""
+    return tuple(sorted(set((tuple(sorted(include)), tuple(sorted(exclude)))
+                            for include, exclude in clauses)))
+
+
+def tag_filter_query(clauses):
+    """Return select of ids of posts matching parsed tag filter.
+
+    Each clause is one grouped query over the tags table. It is
+    restricted to posts of its rarest required tag, so common tags
+    cost little. Returns None if nothing can match.
+
+    Keyword arguments:
+    clauses --- list as returned by parse_tag_filter
+
+    """
+    names = set()
+    for include, exclude in clauses:
+        names |= include | exclude
+    tags = dict((row.name, row) for row in 
+                db.session.query(Tag.name, Tag.id, Tag.post_count)
+                .filter(Tag.name.in_(names)))
+    tag_id = tagsTable.c.tag_id
+    blogpost_id = tagsTable.c.blogpost_id
+    selects = []
+    for include, exclude in clauses:
+        if not include <= set(tags):
+            continue
+        include = [tags[name] for name in include]
+        exclude = [tags[name].id for name in exclude if name in tags]
+        if not include:
+            select = db.select([Blogpost.id])
+            if exclude:
+                select = select.where(~Blogpost.id.in_(
+                    db.select([blogpost_id]).where(tag_id.in_(exclude))))
+        elif len(include) == 1 and not exclude:
+            select = db.select([blogpost_id]).where(tag_id == include[0].id)
+        else:
+            rarest = min(include, key=lambda tag: tag.post_count)
+            counts = [func.sum(case([(tag_id == id, 1)], else_=0)) 
+                      for id in [tag.id for tag in include] + exclude]
+            select = (db.select([blogpost_id])
+                      .where(tag_id.in_([tag.id for tag in include] + 
+                                        exclude))
+                      .where(blogpost_id.in_(db.select([blogpost_id])
+                                             .where(tag_id == rarest.id)))
+                      .group_by(blogpost_id)
+                      .having(db.and_(*([count > 0 for count in 
+                                         counts[:len(include)]] + 
+                                        [count == 0 for count in 
+                                         counts[len(include):]]))))
+        selects.append(select)
+    if not selects:
+        return None
+    if len(selects) == 1:
+        return selects[0]
+    return db.union(*selects)
+
+
+def chunks(items, size=300):
+    """Yield lists of at most size items.
+
+    Keeps IN lists under the bound parameter limit of SQLite.
+
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
+
+def apply_tag_changes(rows):
+    """Make tags match rows submitted from the tag editor.
+
+    Rows are compared against one snapshot of all tags and the
+    differences are written with set-based statements.
+    Tags missing from rows are removed along with their post
+    associations, but only if rows include at least one existing tag.
+    Caller has to commit the session.
+    Returns dictionary with amounts of added, renamed and removed tags.
+
+    Keyword arguments:
+    rows -- list of (id, name). id is empty for new tags. \
+    Rows with empty name are skipped.
+
+    """
+    snapshot = dict(db.session.query(Tag.id, Tag.name))
+    kept = {}
+    added = []
+    for id, name in rows:
+        if name == u'':
+            continue
+        if id == u'':
+            added.append(name)
+            continue
+        try:
+            id = int(id)
+        except ValueError:
+            app.logger.warning('Invalid tag id: ' + id)
+            continue
+        if id in snapshot:
+            kept[id] = name
+        else:
+            app.logger.warning('Tag not found: %d' % id)
+    removed = set(snapshot) - set(kept) if kept else set()
+    renamed = dict((id, name) for id, name in kept.iteritems() 
+                   if snapshot[id] != name)
+    tag = Tag.__table__
+    for ids in chunks(removed):
+        db.session.execute(tagsTable.delete()
+                           .where(tagsTable.c.tag_id.in_(ids)))
+        db.session.execute(tag.delete().where(tag.c.id.in_(ids)))
+    for ids in chunks(renamed):
+        db.session.execute(tag.update()
+                           .where(tag.c.id.in_(ids))
+                           .values(name=case([(id, renamed[id]) for id in ids], 
+                                             value=tag.c.id)))
+    if added:
+        db.session.execute(tag.insert(), [{'name': name} for name in added])
+    return {'added': len(added), 
+            'renamed': len(renamed), 
+            'removed': len(removed)}
+
+
+class JobQueue(object):
+    """Write-behind queue of derived data work stored in Job table.
+
+    Requests add jobs in their own transaction and worker threads do
+    them later in batches. Jobs of the same kind and key in a batch
+    are done once, so a post edited many times in a row is indexed
+    once, unless the kind is registered without merging. Jobs left behind by a crash are done when workers start.
+    Without workers jobs are done by notify in the calling thread.
+
+    Each kind is done in its own transaction, so a failing handler
+    does not hold back jobs of other kinds. Failed jobs are tried
+    again on later runs and parked after max_attempts failures.
+
+    """
+
+    HELP = {
+        'tagblog_job_queue_depth': 'Jobs waiting in the queue.',
+        'tagblog_job_queue_lag_seconds': 'Age of the oldest waiting job.',
+        }
+
+    def __init__(self, workers=2, batch_size=100, poll_interval=5, 
+                 max_attempts=5):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._handlers = {}
+        self._unmerged = set()
+        self._threads = []
+        # (kind, key) pairs being worked on by some thread
+        self._active = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+    def register(self, kind, handler, after=None, merge=True):
+        """Register handler of jobs of a kind.
+
+        Keyword arguments:
+        kind --- name of the kind, max 20 length string
+        handler --- called with list of keys, must not commit
+        after --- called with list of keys after handler's work has \
+        been committed
+        merge --- give handler each key once, otherwise once per job
+
+        """
+        self._handlers[kind] = (handler, after)
+        if merge:
+            self._unmerged.discard(kind)
+        else:
+            self._unmerged.add(kind)
+
+    def enqueue(self, kind, *keys):
+        """Add jobs to the session. Caller has to commit and notify."""
+        if keys:
+            db.session.execute(Job.__table__.insert(), 
+                               [{'kind': kind, 'key': key, 
+                                 'created': datetime.utcnow()}
+                                for key in set(keys)])
+
+    def notify(self):
+        """Tell that jobs have been committed."""
+        if self.workers:
+            self.start()
+            self._wakeup.set()
+        else:
+            self.run_pending()
+
+    def start(self):
+        """Start worker threads unless started already."""
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def run_pending(self):
+        """Do jobs until none are left. Returns amount of jobs done.
+
+        Jobs failing during the run are not tried again in it.
+
+        """
+        done = 0
+        failed = set()
+        while True:
+            count = self.run_batch(failed)
+            if not count:
+                return done
+            done += count
+
+    def run_batch(self, failed=None):
+        """Do one batch of jobs, each kind in its own transaction.
+
+        Returns amount of jobs done. Failed jobs are left in the queue
+        with their attempts counted.
+
+        Keyword arguments:
+        failed -- set of job ids to skip, ids of failed jobs are added
+
+        """
+        if failed is None:
+            failed = set()
+        done = 0
+        while True:
+            with self._lock:
+                query = (db.session.query(Job.id, Job.kind, Job.key)
+                         .filter(Job.attempts < self.max_attempts))
+                if failed:
+                    query = query.filter(~Job.id.in_(failed))
+                rows = query.order_by(Job.id).limit(self.batch_size).all()
+                claimed = set((kind, key) for id, kind, key in rows 
+                              if (kind, key) not in self._active)
+                self._active.update(claimed)
+            # Rows are read in a transaction of their own
+            db.session.rollback()
+            if not claimed:
+                return done
+            try:
+                for kind, ids, keys in self._group(rows, claimed):
+                    if self._run(kind, ids, keys):
+                        done += len(ids)
+                    else:
+                        failed.update(ids)
+            finally:
+                with self._lock:
+                    self._active.difference_update(claimed)
+            if done:
+                return done
+
+    def _group(self, rows, claimed):
+        ids = OrderedDict()
+        keys = {}
+        for id, kind, key in rows:
+            if (kind, key) in claimed:
+                ids.setdefault(kind, []).append(id)
+                keys.setdefault(kind, []).append(key)
+        return [(kind, kind_ids, sorted(keys[kind] if kind in self._unmerged 
+                                        else set(keys[kind]))) 
+                for kind, kind_ids in ids.iteritems()]
+
+    def _run(self, kind, ids, keys):
+        """Do jobs of a kind in one transaction. Returns if it worked.
+
+        Returns None without counting an attempt if a worker of another
+        process did the jobs meanwhile, then the work is rolled back.
+
+        """
+        handler, after = self._handlers.get(kind, (None, None))
+        try:
+            if handler is None:
+                raise KeyError('no handler for %s jobs' % kind)
+            handler(keys)
+            # Jobs are deleted after the handler, as handlers may
+            # remove the session
+            deleted = db.session.execute(Job.__table__.delete()
+                                         .where(Job.id.in_(ids))).rowcount
+            if deleted != len(ids):
+                db.session.rollback()
+                return None
+            db.session.commit()
+        except Exception, e:
+            db.session.rollback()
+            app.logger.warning('%s jobs failed: %s' % (kind, e))
+            db.session.execute(Job.__table__.update()
+                               .where(Job.id.in_(ids))
+                               .values(attempts=Job.attempts + 1))
+            db.session.commit()
+            return False
+        if after:
+            try:
+                after(keys)
+            except Exception:
+                app.logger.exception('after %s jobs failed' % kind)
+        return True
+
+    def stats(self):
+        """Return (depth, lag) of the queue.
+
+        Depth is amount of waiting jobs and lag the age of the oldest
+        in seconds. Parked jobs are not waiting.
+
+        """
+        depth, oldest = (db.session.query(func.count(Job.id), 
+                                          func.min(Job.created))
+                         .filter(Job.attempts < self.max_attempts).one())
+        if oldest is None:
+            return depth, 0.0
+        return depth, max((datetime.utcnow() - oldest).total_seconds(), 0.0)
+
+    def exposition(self):
+        """Return depth and lag of the queue in Prometheus text format."""
+        lines = []
+        for name, value in zip(('tagblog_job_queue_depth', 
+                                'tagblog_job_queue_lag_seconds'),
+                               self.stats()):
+            lines.append('# HELP %s %s' % (name, self.HELP[name]))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def stop(self):
+        """Stop worker threads after their current batch."""
+        self._stopping = True
+        self._wakeup.set()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join()
+        self._stopping = False
+
+    def _work(self):
+        with app.app_context():
+            while not self._stopping:
+                # Workers are not replaced, so they must outlive errors
+                try:
+                    self.run_pending()
+                except Exception:
+                    app.logger.exception('job worker failed')
+                finally:
+                    db.session.remove()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+
+def index_posts(ids):
+    """Replace search index postings of posts. Caller has to commit.
+
+    Posts that do not exist any more are only removed from the index.
+
+    """
+    post = Blogpost.__table__
+    for chunk in chunks(ids):
+        db.session.execute(Posting.__table__.delete()
+                           .where(Posting.blogpost_id.in_(chunk)))
+        rows = []
+        for id, title, body in db.session.execute(
+                db.select([post.c.id, post.c.title, post.c.body])
+                .where(post.c.id.in_(chunk))):
+            rows.extend(postings(id, title, body))
+        if rows:
+            db.session.execute(Posting.__table__.insert(), rows)
+
+
+def count_tag_posts(ids, change):
+    """Add change to post counts of tags once per id. Caller has to commit.
+
+    Keyword arguments:
+    ids -- tag ids, an id may be there many times
+    change -- 1 for added and -1 for removed tags
+
+    """
+    tag = Tag.__table__
+    amounts = {}
+    for id, times in Counter(ids).iteritems():
+        amounts.setdefault(times * change, []).append(id)
+    for amount, tag_ids in amounts.iteritems():
+        for chunk in chunks(tag_ids):
+            db.session.execute(tag.update().where(tag.c.id.in_(chunk))
+                               .values(post_count=tag.c.post_count + amount))
+
+
+def derived_data_changed(keys):
+    """Drop cached pages and results depending on derived data."""
+    bump_versions('listing')
+    db.session.commit()
+    post_counts.clear()
+    search_results.clear()
+    response_cache.invalidate('listing')
+
+
+jobs = JobQueue(workers=app.config.get('JOB_WORKERS', 2), 
+                batch_size=app.config.get('JOB_BATCH_SIZE', 100), 
+                poll_interval=app.config.get('JOB_POLL_INTERVAL', 5), 
+                max_attempts=app.config.get('JOB_MAX_ATTEMPTS', 5))
+jobs.register('index', index_posts, after=derived_data_changed)
+# Counts change by one per job, so these jobs are not merged
+jobs.register('tag_added', partial(count_tag_posts, change=1), 
+              after=derived_data_changed, merge=False)
+jobs.register('tag_removed', partial(count_tag_posts, change=-1), 
+              after=derived_data_changed, merge=False)
+
+
+# Bundles of static files, built by manage.py build-assets. Names are
+# relative to the static folder and files are joined in this order.
+ASSET_BUNDLES = OrderedDict([
+    ('css/site.css', ['css/bootstrap.css', 'css/tagblog.css', 
+                      'css/bootstrap-responsive.css']), 
+    ('js/site.js', ['js/jquery.js', 'js/bootstrap.js']), 
+    ])
+
+
+class Assets(object):
+    """Urls of built asset bundles, read from the manifest of the build.
+
+    Built bundles have content hashes in their names, so they can be
+    cached forever. Without a build the files of bundles are linked
+    one by one.
+
+    """
+
+    def __init__(self):
+        self._manifest = None
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        return app.config.get('ASSET_DIR', 
+                              os.path.join(app.static_folder, 'build'))
+
+    def manifest(self):
+        """Return dictionary of bundle name to built file name."""
+        if self._manifest is None:
+            with self._lock:
+                try:
+                    with open(os.path.join(self.directory, 
+                                           'manifest.json')) as manifest:
+                        self._manifest = json.load(manifest)
+                except IOError:
+                    self._manifest = {}
+        return self._manifest
+
+    def reload(self):
+        """Read the manifest again on next use."""
+        self._manifest = None
+
+    def urls(self, bundle):
+        """Return list of urls to load bundle from."""
+        built = self.manifest().get(bundle)
+        if built is not None:
+            return [url_for('asset', filename=built)]
+        return [url_for('static', filename=name) 
+                for name in ASSET_BUNDLES[bundle]]
+
+
+assets = Assets()
+app.jinja_env.globals['asset_urls'] = assets.urls
+
+
+class Feeds(object):
+    """Atom and JSON feeds of the latest posts kept in files.
+
+    Feeds are written with gzipped copies to FEED_DIR, so serving them
+    needs no database. 'feed' jobs rebuild the feed of all posts and
+    feeds of changed tags that have been built before. Jobs are done
+    by whichever process gets them, so with many web processes or
+    hosts FEED_DIR must be storage shared by all of them. Entries are
+    cached by post version and version of tags, so a rebuild renders
+    only posts changed since, whichever process changed them.
+
+    """
+    FORMATS = {'atom': 'application/atom+xml', 
+               'json': 'application/json'}
+
+    def __init__(self, size=20):
+        self.size = size
+        self._entries = LRUCache(maxsize=1000)
+
+    @property
+    def directory(self):
+        return app.config.get('FEED_DIR', 
+                              os.path.join(app.instance_path, 'feeds'))
+
+    def path(self, tag, format):
+        """Return file path of feed of tag name, or all posts if None."""
+        name = 'all'
+        if tag is not None:
+            name = 'tag-' + hashlib.sha1(tag.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '%s.%s' % (name, format))
+
+    def build(self, tag=None):
+        """Write feeds of tag name, or all posts if None."""
+        post = Blogpost.__table__
+        latest = db.select([post.c.id, post.c.version])
+        if tag is not None:
+            latest = latest.where(post.c.id.in_(
+                db.select([tagsTable.c.blogpost_id], 
+                          tagsTable.c.tag_id == Tag.__table__.c.id)
+                .where(Tag.__table__.c.name == tag)))
+        latest = db.session.execute(latest.order_by(desc(post.c.id))
+                                    .limit(self.size)).fetchall()
+        tags = content_versions().get('tags', (0, None))[0]
+        entries = dict((id, self._entries.get((id, version, tags))) 
+                       for id, version in latest)
+        missing = [id for id, entry in entries.items() if entry is None]
+        with app.test_request_context(
+                base_url=app.config.get('SITE_URL', 'http://localhost/')):
+            if missing:
+                for post in (Blogpost.query
+                             .options(db.subqueryload(Blogpost.tags))
+                             .filter(Blogpost.id.in_(missing))):
+                    entries[post.id] = self._render_entry(post)
+                    self._entries.set((post.id, post.version, tags), 
+                                      entries[post.id])
+            entries = [entries[id] for id, version in latest]
+            self._write(tag, entries)
+
+    def _render_entry(self, post):
+        url = url_for('post', id=post.id, _external=True)
+        return (Markup(render_template('feed_entry.xml', post=post, url=url)), 
+                {'id': url, 
+                 'url': url, 
+                 'title': post.title, 
+                 'summary': post.excerpt, 
+                 'content_text': post.body, 
+                 'date_modified': post.updated.isoformat() + 'Z', 
+                 'tags': [t.name for t in post.tags]}, 
+                post.updated)
+
+    def _write(self, tag, entries):
+        title = 'Tagblog' if tag is None else 'Tagblog: %s' % tag
+        if tag is None:
+            home_url = url_for('index', _external=True)
+        else:
+            home_url = url_for('tag', name=tag, _external=True)
+        updated = max([entry[2] for entry in entries] or 
+                      [datetime(1970, 1, 1)])
+        atom = render_template('feed.xml', 
+                               title=title, 
+                               home_url=home_url, 
+                               feed_url=self.url(tag, 'atom'), 
+                               updated=updated.isoformat() + 'Z', 
+                               author=app.config.get('FEED_AUTHOR', 'Tagblog'), 
+                               entries=[entry[0] for entry in entries])
+        data = json.dumps({'version': 'https://jsonfeed.org/version/1', 
+                           'title': title, 
+                           'home_page_url': home_url, 
+                           'feed_url': self.url(tag, 'json'), 
+                           'items': [entry[1] for entry in entries]})
+        self._write_file(self.path(tag, 'atom'), atom.encode('utf-8'))
+        self._write_file(self.path(tag, 'json'), data)
+
+    def url(self, tag, format):
+        """Return external url of feed of tag name, or all posts if None."""
+        if tag is None:
+            return url_for('feed', format=format, _external=True)
+        return url_for('feed', name=tag, format=format, _external=True)
+
+    def _write_file(self, path, data):
+        # Write both copies under temporary names and rename them into
+        # place, so readers never see half written feeds
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temporary = '%s.%d.%d' % (path, os.getpid(), 
+                                  threading.current_thread().ident)
+        with open(temporary, 'wb') as out:
+            out.write(data)
+        with gzip.open(temporary + '.gz', 'wb') as out:
+            out.write(data)
+        os.rename(temporary + '.gz', path + '.gz')
+        os.rename(temporary, path)
+
+    def clear_tags(self):
+        """Remove feeds of tags. They are built again when requested."""
+        self._remove('tag-')
+
+    def clear(self):
+        """Remove all feeds and cached entries."""
+        self._remove('')
+        self._entries.clear()
+
+    def _remove(self, prefix):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix):
+                os.remove(os.path.join(self.directory, name))
+
+
+feeds = Feeds(size=app.config.get('FEED_SIZE', 20))
+
+
+def build_feeds(keys):
+    """Rebuild feed of all posts if 0 in keys and built feeds of tag ids."""
+    if 0 in keys:
+        feeds.build()
+    ids = [key for key in keys if key]
+    for chunk in chunks(ids):
+        for name, in db.session.query(Tag.name).filter(Tag.id.in_(chunk)):
+            if os.path.exists(feeds.path(name, 'atom')):
+                feeds.build(name)
+
+
+jobs.register('feed', build_feeds)
+
+
+@app.before_first_request
+def start_jobs():
+    """Start job workers, which also do jobs left from earlier runs."""
+    if jobs.workers:
+        jobs.start()
+
+
+def reads_from_replica(view):
+    """Decorate view to read from the 'replica' bind if there is one.
+
+    Logged in users read from the primary so they see their own
+    changes right away.
+
+    """
+    @wraps(view)
+    def wrapper(**kwargs):
+        if ('replica' in (app.config.get('SQLALCHEMY_BINDS') or ()) and 
+                not current_user.is_authenticated()):
+            g.db_bind = 'replica'
+        return view(**kwargs)
+    return wrapper
+
+
+# WSGI environment key set while rendering pages for manage.py export-site
+STATIC_SITE = 'tagblog.static_site'
+
+
+def static_site():
+    """Return True if the page is rendered for the static site export.
+
+    Static pages have no forms and link numbered pages instead of
+    cursors, because flat files can not read query strings.
+
+    """
+    return has_request_context() and request.environ.get(STATIC_SITE, False)
+
+
+app.jinja_env.globals['static_site'] = static_site
+
+
+def stream_template(template_name, **context):
+    """Return response sending the template while it is rendered.
+
+    Like render_template, but the start of the page is sent before the
+    rest is rendered. The session is saved before the page is sent, so
+    flashed messages are read here and forms, with their CSRF tokens,
+    must be made before calling this.
+
+    """
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(app.config.get('STREAM_BUFFER_SIZE', 40))
+    current = _request_ctx_stack.top
+    opened = current.session
+    body = stream_with_context(part.encode('utf-8') for part in stream)
+    # Keeping the context opens the session again, which would lose
+    # the changes of this request
+    current.session = opened
+    return app.response_class(body, mimetype='text/html')
+
+
 def redirect_next_or_index():
     """
     Return page to redirect to.
@@ -236,64 +2547,316 @@ def redirect_next_or_index():
     return redirect(url_for('index'))
 
 
+# Built assets are cached by clients for a year
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+# Pages are revalidated at least this often so that their
+# CSRF tokens do not expire while clients keep reusing them.
+REVALIDATE_INTERVAL = 15 * 60
+
+
+class PageValidators(object):
+    """Validators of the page being rendered, looked up at most once.
+
+    Cached pages remember their validators and set them here,
+    so a cache hit needs no lookup.
+
+    """
+    _missing = object()
+
+    def __init__(self, lookup, kwargs):
+        self._lookup = lookup
+        self._kwargs = kwargs
+        self._value = self._missing
+
+    def get(self):
+        """Return (version, last_modified) or None if unknown."""
+        if self._value is self._missing:
+            self._value = self._lookup(**self._kwargs)
+        return self._value
+
+    def set(self, value):
+        """Set already known validators."""
+        self._value = value
+
+
+def conditional(validators):
+    """Decorate view to answer conditional GET requests.
+
+    validators is called with keyword arguments of the view and returns
+    (version, last_modified) of the content or None if unknown.
+    A fresh client copy is answered with 304 without calling the view.
+
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(**kwargs)
+            g.page_validators = PageValidators(validators, kwargs)
+            response = None
+            if ('If-None-Match' in request.headers or 
+                    request.if_modified_since):
+                found = g.page_validators.get()
+                if found is not None and is_fresh(*page_validators(*found)):
+                    response = app.response_class(status=304)
+            if response is None:
+                # Validators are looked up before the page is rendered,
+                # so an edit in between can not give an older page the
+                # newer etag. Response cache looks them up itself, as
+                # its hits know them already.
+                if not response_cache.cacheable():
+                    g.page_validators.get()
+                response = app.make_response(view(**kwargs))
+                found = g.page_validators.get()
+                if response.status_code != 200 or found is None:
+                    return response
+            etag, modified = page_validators(*found)
+            response.set_etag(etag)
+            response.last_modified = modified
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['Vary'] = 'Cookie'
+            return response
+        return wrapper
+    return decorator
+
+
+def page_validators(version, modified):
+    """Return (etag, last_modified) of the page for current client.
+
+    Page also depends on who is looking and the CSRF key in their
+    session. Pages with CSRF tokens are revalidated every now and then.
+
+    """
+    if app.config.get('CSRF_ENABLED', True):
+        now = int(time.time())
+        floor = datetime.utcfromtimestamp(now - now % REVALIDATE_INTERVAL)
+        modified = max(modified, floor)
+        version = (version, floor)
+    etag = hashlib.sha1(repr((version, 
+                              current_user.get_id(), 
+                              session.get('csrf')))).hexdigest()
+    return etag, modified
+
+
+def is_fresh(etag, modified):
+    """Check if client copy of the page is still valid."""
+    # Compressed pages have weak etags, which the set of if_none_match
+    # does not count when tested for truth
+    if 'If-None-Match' in request.headers:
+        return request.if_none_match.contains_weak(etag)
+    return (request.if_modified_since is not None and 
+            modified <= request.if_modified_since)
+
+
+def listing_validators(**kwargs):
+    """Return validators of pages listing posts."""
+    versions = content_versions()
+    listing, tags = [versions.get(name, (0, datetime(1970, 1, 1))) 
+                     for name in ('listing', 'tags')]
+    return (listing[0], tags[0]), max(listing[1], tags[1])
+
+
+def post_validators(id):
+    """Return validators of post page or None if post not found."""
+    post = (db.session.query(Blogpost.version, Blogpost.updated)
+            .filter_by(id=id).first())
+    if post is None:
+        return None
+    tags = content_versions().get('tags', (0, datetime(1970, 1, 1)))
+    return (post.version, tags[0]), max(post.updated, tags[1])
+
+
 @app.route('/<page>')
 @app.route('/')
-def index(page=1):
-    """Index page listing all blogposts."""
-    page = max(int(page), 1)
-    posts = Blogpost.query.limit(10).offset((page-1)*10).all()
+@reads_from_replica
+@conditional(listing_validators)
+@response_cache.cached('listing', 'tags')
+def index(page=None):
+    """Index page listing all blogposts.
+
+    Pages are addressed with cursor tokens. Numbered pages are
+    still supported for old links.
+
+    """
+    if page is None:
+        page, after, before = read_cursor(1)
+    else:
+        # Compatibility path. Only the ids are skipped with offset.
+        page = max(int(page), 1)
+        after = before = None
+        if page > 1:
+            after = (db.session.query(Blogpost.id)
+                     .order_by(Blogpost.id)
+                     .offset((page-1)*POSTS_PER_PAGE-1).limit(1).scalar())
+            if after is None:
+                abort(404)
+            after = (after,)
+    if slim_reads():
+        posts, has_prev, has_next = keyset_rows(
+            post_select(), 
+            after=after and after[0], 
+            before=before and before[0])
+    else:
+        posts, has_prev, has_next = keyset_page(
+            Blogpost.listing(), 
+            after=after and after[0], 
+            before=before and before[0])
     # How many pages of posts we have
-    pages = int(math.ceil(float(Blogpost.query.count())/10))
-    return render_template('index.html', 
+    pages = count_pages(post_counts.get_or_create('all', 
+                                                  Blogpost.query.count))
+    prev_cursor, next_cursor = listing_cursors(page, posts, 
+                                               has_prev, has_next)
+    return stream_template('index.html', 
                             posts=posts, 
                             pages=pages, 
                             page=page, 
+                            prev_cursor=prev_cursor, 
+                            next_cursor=next_cursor, 
                             loginform=LoginForm(), 
                             addpostform=BlogpostForm())
 
 
 @app.route('/search')
+@reads_from_replica
+@conditional(listing_validators)
+@response_cache.cached('listing', 'tags')
 def search():
-    """Page for searching posts"""
-    try:
-        queryString = (
-            request.values['query']
-            .replace('/','//').replace('%','/%')
-            .replace('_','/_')
-        )
-    except KeyError:
+    """Page for searching posts.
+
+    Text query is given in 'query' value and tag filter like
+    'python AND performance NOT draft' in 'tags' value.
+    Either one is enough.
+
+    """
+    if 'query' not in request.values and 'tags' not in request.values:
         flash('Search query not present')
         return redirect_next_or_index()
-    # Try to get page from GET or POST data.
-    # Fall back to 1 if fails or <1.
+    query = request.values.get('query', u'')
+    tag_filter = request.values.get('tags', u'')
+    terms = tokenize(query)
+    clauses = parse_tag_filter(tag_filter)
+    filtered = tag_filter_query(clauses) if clauses else None
     page = 1
-    try:
-        page = int(request.values['page'])
-    except:
+    posts = []
+    pages = 0
+    snippets = {}
+    prev_cursor = next_cursor = None
+    if clauses and filtered is None:
+        # Every clause requires a tag that does not exist
         pass
-    page = max(page, 1)
-    terms = queryString.split()
-    # Maximum amount of terms is 11 or things will crash.
-    if len(terms) > 11:
-        flash('Too many search terms. 11 is maximum.')
-        return render_template('search.html', 
-                                posts=[], 
-                                pages=0, 
-                                page=page, 
-                                loginform=LoginForm(), 
-                                addpostform=BlogpostForm()) 
-    # I will leave database optimization to database engine.
-    query = Blogpost.query
-    for term in terms:
-        query1 = Blogpost.query.filter(Blogpost.title.like('%'+term+'%'))
-        query2 = Blogpost.query.filter(Blogpost.body.like('%'+term+'%'))
-        query = query.intersect(query1.union(query2))
-    posts = query.limit(10).offset((page-1)*10).all()
-    pages = int(math.ceil(float(query.count())/10))
-    return render_template('search.html', 
+    elif terms:
+        results = cached_search(terms, clauses, filtered)
+        if results is not None:
+            page, posts, prev_cursor, next_cursor = results_page(results)
+            pages = count_pages(len(results))
+        else:
+            ranked, score = search_query(terms)
+            if filtered is not None:
+                ranked = ranked.filter(Posting.blogpost_id.in_(filtered))
+            page, posts, prev_cursor, next_cursor = ranked_page(ranked, score)
+            pages = count_pages(post_counts.get_or_create(
+                ('search', tuple(sorted(set(terms))), filter_key(clauses)), 
+                ranked.count))
+        snippets = search_snippets(posts, terms)
+    elif filtered is not None:
+        page, after, before = read_cursor(1)
+        if slim_reads():
+            posts, has_prev, has_next = keyset_rows(
+                post_select().where(Blogpost.__table__.c.id.in_(filtered)), 
+                after=after and after[0], 
+                before=before and before[0])
+        else:
+            posts, has_prev, has_next = keyset_page(
+                Blogpost.listing().filter(Blogpost.id.in_(filtered)), 
+                after=after and after[0], 
+                before=before and before[0])
+        prev_cursor, next_cursor = listing_cursors(page, posts, 
+                                                   has_prev, has_next)
+        pages = count_pages(post_counts.get_or_create(
+            ('tags', filter_key(clauses)), 
+            db.session.query(func.count())
+            .select_from(filtered.alias()).scalar))
+    return stream_template('search.html', 
                             posts=posts, 
                             pages=pages, 
                             page=page, 
+                            query=query, 
+                            tags=tag_filter, 
+                            snippets=snippets, 
+                            prev_cursor=prev_cursor, 
+                            next_cursor=next_cursor, 
+                            loginform=LoginForm(), 
+                            addpostform=BlogpostForm())
+
+
+@app.route('/tag/<name>/<int:page>')
+@app.route('/tag/<name>')
+@reads_from_replica
+@conditional(listing_validators)
+@response_cache.cached('listing', 'tags')
+def tag(name, page=None):
+    """Page listing posts with the tag.
+
+    Pages are addressed with cursor tokens. Numbered pages are used
+    by the static site export.
+
+    Keyword arguments:
+    name --- name of the tag
+    page --- number of the page
+
+    """
+    tag = Tag.query.filter_by(name=name).first()
+    if tag is None:
+        abort(404)
+    if page is None:
+        page, after, before = read_cursor(1)
+    else:
+        page = max(page, 1)
+        after = before = None
+        if page > 1:
+            after = (db.session.query(tagsTable.c.blogpost_id)
+                     .filter(tagsTable.c.tag_id == tag.id)
+                     .order_by(tagsTable.c.blogpost_id)
+                     .offset((page-1)*POSTS_PER_PAGE-1).limit(1).scalar())
+            if after is None:
+                abort(404)
+            after = (after,)
+    posts, has_prev, has_next = keyset_page(
+        Blogpost.listing()
+        .join(tagsTable, tagsTable.c.blogpost_id == Blogpost.id)
+        .filter(tagsTable.c.tag_id == tag.id), 
+        after=after and after[0], 
+        before=before and before[0])
+    prev_cursor, next_cursor = listing_cursors(page, posts, 
+                                               has_prev, has_next)
+    return render_template('tag.html', 
+                            tag=tag, 
+                            posts=posts, 
+                            pages=count_pages(tag.post_count), 
+                            page=page, 
+                            prev_cursor=prev_cursor, 
+                            next_cursor=next_cursor, 
+                            loginform=LoginForm(), 
+                            addpostform=BlogpostForm())
+
+
+@app.route('/tags')
+@reads_from_replica
+@conditional(listing_validators)
+@response_cache.cached('listing', 'tags')
+def tags():
+    """Page showing tag cloud of tags having posts."""
+    tags = (Tag.query.filter(Tag.post_count > 0)
+            .order_by(Tag.name).all())
+    # Font size grows with logarithm of post count
+    most = max([tag.post_count for tag in tags] or [1])
+    sizes = dict((tag.id, 1 + int(4 * math.log(tag.post_count) / 
+                                  math.log(most + 1)))
+                 for tag in tags)
+    return render_template('tags.html', 
+                            tags=tags, 
+                            sizes=sizes, 
                             loginform=LoginForm(), 
                             addpostform=BlogpostForm())
 
@@ -321,46 +2884,23 @@ def edittags():
                                 addpostform=BlogpostForm())
     else:
         tagForm = TagForm(request.form)
-        tags = []
-        for entry in tagForm.tags.entries:
-            tags.append((entry.data['id'], entry.data['name']))
-        # First lets remove all empty lines.
-        tags[:] = [tag for tag in tags if not (tag[1] == u'')]
-        # New entries have no id
-        newEntries = [tag for tag in tags if (tag[0] == u'')]
-        # We have them in separate list so lets remove them from first
-        tags[:] = [tag for tag in tags if not tag in newEntries]
-        # Lets remove tags that were not returned
-        ids = [int(tag[0]) for tag in tags]
-        if ids:
-            #  Delete dosen't work right without this
-            db.session.commit()
-            app.logger.debug('Removing '+
-                str(
-                    Tag.query.filter(Tag.id.notin_(ids))
-                    .delete(synchronize_session=False))
-                +' tags')
-        # db.session.commit() # When sure, we delete
-        # We need to still update old tags.
-        # Lets first load all tags to memory so that
-        # no extra sql queries are needed.
-        # After all we edit every tag.
-        tmpTags = Tag.query.all()
-        for tag in tags:
-            try:
-                updatedTag = Tag.query.get(int(tag[0]))
-                updatedTag.name = tag[1]
-                db.session.add(updatedTag)
-            except:
-                app.logger.warning('Error retrieving tag: '+tag[0])
-        # Add new entries
-        for entry in newEntries:
-            tag = Tag(entry[1])
-            db.session.add(tag)
+        rows = [(entry.data['id'], entry.data['name']) 
+                for entry in tagForm.tags.entries]
         # Commit changes
         try:
+            changes = apply_tag_changes(rows)
+            bump_versions('tags')
+            jobs.enqueue('feed', 0)
             db.session.commit()
-            flash('Tags saved')
+            # Counts and search results are cached by tag names
+            post_counts.clear()
+            search_results.clear()
+            tag_choices.invalidate()
+            response_cache.invalidate('tags')
+            feeds.clear_tags()
+            jobs.notify()
+            flash('Tags saved: %(added)d added, %(renamed)d renamed, '
+                  '%(removed)d removed' % changes)
         except IntegrityError, e:
             flash('Got integrity error. \
                    Sure you didn\'t give same name to two or more tags?')
@@ -387,7 +2927,17 @@ def addpost():
                 tags = Tag.query.filter(Tag.id.in_(tags)).all()
             post = Blogpost(title, body, tags)
             db.session.add(post)
+            db.session.flush()
+            jobs.enqueue('index', post.id)
+            jobs.enqueue('tag_added', *[tag.id for tag in post.tags])
+            jobs.enqueue('feed', 0, *[tag.id for tag in post.tags])
+            bump_versions('listing')
             db.session.commit()
+            jobs.notify()
+            post_counts.clear()
+            search_results.clear()
+            tag_choices.invalidate()
+            response_cache.invalidate('listing')
             return redirect(url_for('post', id=post.id))
     except Exception, e:
         app.logger.warning(str(e))
@@ -411,9 +2961,22 @@ def editpost():
             tags = editpostform.tags.data
             if tags: 
                 tags = Tag.query.filter(Tag.id.in_(tags)).all()
+            old_ids = set(tag.id for tag in post.tags)
+            new_ids = set(tag.id for tag in tags)
             post.tags = tags
+            post.touch()
             db.session.add(post)
+            jobs.enqueue('index', post.id)
+            jobs.enqueue('tag_added', *(new_ids - old_ids))
+            jobs.enqueue('tag_removed', *(old_ids - new_ids))
+            jobs.enqueue('feed', 0, *(old_ids | new_ids))
+            bump_versions('listing')
             db.session.commit()
+            jobs.notify()
+            post_counts.clear()
+            search_results.clear()
+            tag_choices.invalidate()
+            response_cache.invalidate('listing', 'post:%s' % post.id)
             return redirect(url_for('post', id=post.id))
         else:
             app.logger.warning(str(editpostform.errors))
@@ -432,13 +2995,85 @@ def deletepost():
 
     """
     id = request.values['postid']
+    unindex_post(id)
+    tag_ids = [row[0] for row in db.session.query(tagsTable.c.tag_id)
+               .filter(tagsTable.c.blogpost_id == id)]
+    db.session.execute(tagsTable.delete()
+                       .where(tagsTable.c.blogpost_id == id))
+    adjust_tag_counts(removed=tag_ids)
     Blogpost.query.filter_by(id=id).delete()
+    jobs.enqueue('feed', 0, *tag_ids)
+    bump_versions('listing')
     db.session.commit()
+    jobs.notify()
+    post_counts.clear()
+    search_results.clear()
+    response_cache.invalidate('listing', 'post:%s' % id)
     flash('Deleted the post')
     return redirect_next_or_index()
 
 
+@app.route('/feed.<format>')
+@app.route('/tag/<name>/feed.<format>')
+def feed(format, name=None):
+    """Atom or JSON feed of latest posts, of tag if name is given.
+
+    Feeds are served from files built by Feeds. Missing feeds are
+    built on first request.
+
+    """
+    if format not in Feeds.FORMATS:
+        abort(404)
+    path = feeds.path(name, format)
+    if not os.path.exists(path):
+        if name is not None and not Tag.query.filter_by(name=name).count():
+            abort(404)
+        feeds.build(name)
+    if request.accept_encodings['gzip']:
+        path += '.gz'
+    with open(path, 'rb') as feed_file:
+        data = feed_file.read()
+    modified = os.path.getmtime(path)
+    response = app.response_class(data, mimetype=Feeds.FORMATS[format])
+    if path.endswith('.gz'):
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.last_modified = datetime.utcfromtimestamp(int(modified))
+    response.set_etag('%x-%x' % (int(modified * 1000), len(data)))
+    return response.make_conditional(request)
+
+
+@app.route('/static/build/<path:filename>')
+def asset(filename):
+    """Built asset bundle, compressed copy if the client accepts it.
+
+    Names of built files change with their content, so they are
+    cached as immutable.
+
+    """
+    path = safe_join(assets.directory, filename)
+    if not os.path.isfile(path) or filename == 'manifest.json':
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = None
+    for name, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[name] and os.path.isfile(path + suffix):
+            encoding = name
+            path += suffix
+            break
+    response = send_file(path, mimetype=mimetype, cache_timeout=ASSET_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = ('public, max-age=%d, immutable' % 
+                                         ASSET_MAX_AGE)
+    return response
+
+
 @app.route('/post/<id>')
+@reads_from_replica
+@conditional(post_validators)
+@response_cache.cached('post:{id}', 'tags')
 def post(id):
     """Page for viewing the post.
 
@@ -447,10 +3082,15 @@ def post(id):
 
     """
     try:
-        post = Blogpost.query.filter_by(id=id).first()
+        if slim_reads():
+            post = post_rows(post_select(body=True)
+                             .where(Blogpost.__table__.c.id == id))
+            post = post[0] if post else None
+        else:
+            post = Blogpost.query.filter_by(id=id).first()
         if post:
             editpostform = BlogpostForm(post=post)
-            return render_template('post.html', 
+            return stream_template('post.html', 
                                     post=post, id=id, 
                                     editpostform=editpostform, 
                                     loginform=LoginForm(), 
@@ -460,6 +3100,66 @@ def post(id):
     return redirect_next_or_index()
 
 
+@app.route('/metrics')
+def metrics():
+    """Page with instrumentation histograms in Prometheus format.
+
+    Needs METRICS_TOKEN setting as bearer token or an admin user.
+
+    """
+    if not instrumentation.enabled:
+        abort(404)
+    token = app.config.get('METRICS_TOKEN')
+    if token:
+        given = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(str(given), 'Bearer ' + str(token)):
+            abort(403)
+    elif not (current_user.is_authenticated() and current_user.is_admin()):
+        abort(403)
+    return app.response_class(instrumentation.exposition() + 
+                              jobs.exposition(), 
+                              mimetype='text/plain; version=0.0.4')
+
+
+def client_address():
+    """Return address of the client.
+
+    Behind a proxy (BEHIND_PROXY setting) it is the address the proxy
+    appended to X-Forwarded-For.
+
+    """
+    if app.config.get('BEHIND_PROXY', False) and request.access_route:
+        return request.access_route[-1]
+    return request.remote_addr
+
+
+def verify_login(user, password):
+    """Check password of user on password_executor.
+
+    Unknown users (user is None) are checked against a dummy hash to
+    take as long as known ones. Hashes of old work factor are replaced
+    after successful check. Raises ExecutorBusy if there are too many
+    logins going on.
+
+    Keyword arguments:
+    user -- User or None
+    password -- password from the login form
+
+    """
+    if user is None:
+        iterations = app.config.get('PASSWORD_HASH_ITERATIONS', 50000)
+        dummy = _dummy_hashes.get_or_create(
+            iterations, lambda: make_password_hash('', iterations))
+        password_executor.call(check_password, dummy, password)
+        return False
+    if not password_executor.call(check_password, user._pw_hash, password):
+        return False
+    if password_needs_rehash(user._pw_hash):
+        user._pw_hash = password_executor.call(make_password_hash, password)
+        db.session.commit()
+    return True
+
+
 @app.route('/login', methods=('GET', 'POST'))
 def login():
     """Page that logs in the user. Login data must be as form data"""
@@ -469,13 +3169,25 @@ def login():
     # get login data and validate it
     form = LoginForm(request.form)
     if form.validate_on_submit():
+        keys = (('username', form.username.data.lower()),
+                ('address', client_address()))
+        if login_throttle.blocked(*keys):
+            flash('too many login attempts, try again later')
+            return redirect(url_for('index'))
         user = User.query.filter_by(username=form.username.data).first()
-        if user==None or not user.check_password(form.password.data):
+        try:
+            valid = verify_login(user, form.password.data)
+        except ExecutorBusy:
+            flash('too many logins at the moment, try again later')
+            return redirect(url_for('index'))
+        if not valid:
             app.logger.debug('user not found or invalid password. User is ' + 
                              (user.username if user else '<None>'))
+            login_throttle.fail(*keys)
             flash('invalid credentials')
             return redirect(url_for('index'))
         else:
+            login_throttle.reset(keys[0])
             login_user(user)
             app.logger.debug('logged in user: '+user.username)
     for error in form.errors:
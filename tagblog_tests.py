@@ -2,9 +2,42 @@ import os
 #Lets use test settings
 os.environ['TAGBLOG_SETTINGS_FILE'] = 'test_settings.py'
 import tagblog
+import manage
+import json
+import re
+import threading
+import time
 import unittest
 import tempfile
+from contextlib import contextmanager
+from gzip import GzipFile
+from StringIO import StringIO
 from flask.ext.sqlalchemy import SQLAlchemy
+from flask.testing import FlaskClient
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+
+# Statements executed while counting queries are collected here
+_statements = None
+
+
+@event.listens_for(tagblog.db.engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, many):
+    if _statements is not None:
+        _statements.append(statement)
+
+class BufferedClient(FlaskClient):
+    """Test client reading streamed pages before returning them.
+
+    Streamed pages keep their request context until they are read.
+
+    """
+
+    def open(self, *args, **kwargs):
+        kwargs.setdefault('buffered', True)
+        return FlaskClient.open(self, *args, **kwargs)
+
+tagblog.app.test_client_class = BufferedClient
 
 class TagblogTestCase(unittest.TestCase):
     """Test tagblog library/site"""
@@ -14,6 +47,14 @@ class TagblogTestCase(unittest.TestCase):
         # Empty table
         tagblog.db.drop_all()
         tagblog.db.create_all()
+        tagblog.post_counts.clear()
+        tagblog.tag_choices.invalidate()
+        tagblog.response_cache.backend.clear()
+        tagblog.login_throttle.clear()
+        tagblog.user_cache.clear()
+        tagblog.snippet_cache.clear()
+        tagblog.search_results.clear()
+        tagblog.feeds.clear()
         # Create test user
         tagblog.db.session.add(tagblog.User('admin', 'default'))
         tagblog.db.session.commit()
@@ -33,6 +74,18 @@ class TagblogTestCase(unittest.TestCase):
     def logout(self):
         return self.app.get('/logout', follow_redirects=True)
 
+    @contextmanager
+    def assertQueries(self, expected):
+        """Assert that the block executes expected amount of SQL."""
+        global _statements
+        _statements = []
+        try:
+            yield _statements
+            statements = _statements
+        finally:
+            _statements = None
+        assert len(statements) == expected, '\n'.join(statements)
+
     def test_empty_db(self):
         # Database empty
         assert tagblog.Blogpost.query.count() == 0
@@ -88,6 +141,95 @@ class TagblogTestCase(unittest.TestCase):
         assert 'Hello' not in rv.data
         assert 'Logout' not in rv.data
 
+    def test_login_throttle(self):
+        for _ in range(tagblog.login_throttle.limit):
+            rv = self.login('admin', 'wrong')
+            assert 'invalid credentials' in rv.data
+        # Correct password does not help while blocked
+        rv = self.login('admin', 'default')
+        assert 'too many login attempts' in rv.data
+        assert 'Hello, admin' not in rv.data
+        tagblog.login_throttle.clear()
+        rv = self.login('admin', 'default')
+        assert 'Hello, admin' in rv.data
+
+    def test_login_executor_limit(self):
+        executor = tagblog.password_executor
+        threads = tagblog.app.config.get('WAITRESS_THREADS', 4)
+        assert 0 < executor.limit < threads
+        release = threading.Event()
+        callers = [threading.Thread(target=executor.call, 
+                                    args=(release.wait,))
+                   for _ in range(executor.limit)]
+        for caller in callers:
+            caller.start()
+        try:
+            # Logins fail fast while other request threads are free
+            while executor._pending < executor.limit:
+                time.sleep(0.01)
+            rv = self.login('admin', 'default')
+            assert 'too many logins at the moment' in rv.data
+        finally:
+            release.set()
+            for caller in callers:
+                caller.join()
+        rv = self.login('admin', 'default')
+        assert 'Hello, admin' in rv.data
+        # Callers waiting too long give up
+        blocked = tagblog.BoundedExecutor(workers=1, limit=2, timeout=0.01)
+        release.clear()
+        try:
+            self.assertRaises(tagblog.ExecutorBusy, 
+                              blocked.call, release.wait)
+        finally:
+            release.set()
+
+    def test_password_rehash(self):
+        user = tagblog.User.query.filter_by(username='admin').first()
+        user._pw_hash = tagblog.make_password_hash('default', 10)
+        tagblog.db.session.commit()
+        assert tagblog.password_needs_rehash(user._pw_hash)
+        rv = self.login('admin', 'default')
+        assert 'Hello, admin' in rv.data
+        user = tagblog.User.query.filter_by(username='admin').first()
+        assert not tagblog.password_needs_rehash(user._pw_hash)
+        assert user.check_password('default')
+        assert not user.check_password('defaultx')
+
+    def test_user_cache(self):
+        self.login('admin', 'default')
+        user = tagblog.load_user(u'1')
+        assert isinstance(user, tagblog.LoadedUser)
+        assert user.username == 'admin' and user.is_admin()
+        assert tagblog.load_user(u'1') is user
+        assert tagblog.load_user(u'x') is None
+        admin = tagblog.User.query.get(1)
+        admin.set_password('changed')
+        tagblog.db.session.commit()
+        assert tagblog.load_user(u'1') is not user
+        tagblog.db.session.delete(admin)
+        tagblog.db.session.commit()
+        assert tagblog.load_user(u'1') is None
+
+    def test_excerpt(self):
+        body = ' '.join(['word%d' % i for i in range(100)])
+        post = tagblog.Blogpost('title', body, [])
+        assert post.excerpt == tagblog.make_excerpt(body)
+        assert len(post.excerpt) <= tagblog.EXCERPT_LENGTH + 4
+        assert post.excerpt.endswith('...')
+        tagblog.db.session.add(post)
+        tagblog.db.session.commit()
+        post.body = 'short body'
+        tagblog.db.session.commit()
+        assert post.excerpt == 'short body'
+        tagblog.db.session.remove()
+        # Listing pages do not load bodies
+        self.app.get('/')
+        with self.assertQueries(3) as statements:
+            rv = self.app.get('/')
+        assert 'short body' in rv.data
+        assert not any('blogpost.body' in s for s in statements)
+
     def test_tags(self):
         # First we have empty tag database.
         assert tagblog.Tag.query.count() == 0
@@ -117,6 +259,79 @@ class TagblogTestCase(unittest.TestCase):
         assert tagblog.Tag.query.filter_by(name='testingtag2').count() == 1
         assert (tagblog.Tag.query.filter_by(name='anothertestingtag').count()   == 1)
 
+    def test_tags_bulk_edit(self):
+        tags = [tagblog.Tag('tag%d' % i) for i in range(5)]
+        post = tagblog.Blogpost('title', 'body', tags)
+        tagblog.db.session.add(post)
+        tagblog.db.session.commit()
+        self.login('admin', 'default')
+        rv = self.app.post('/edittags', data={
+                            'tags-0-id':'1', 'tags-0-name':'renamed',
+                            'tags-1-id':'2', 'tags-1-name':'tag1',
+                            'tags-2-id':'3', 'tags-2-name':'',
+                            'tags-3-id':'', 'tags-3-name':'new1',
+                            'tags-4-id':'', 'tags-4-name':'new2'},
+                            follow_redirects=True)
+        assert 'Tags saved: 2 added, 1 renamed, 3 removed' in rv.data
+        names = sorted(t.name for t in tagblog.Tag.query)
+        assert names == ['new1', 'new2', 'renamed', 'tag1']
+        # Associations of removed tags are gone too
+        assert (tagblog.db.session.query(tagblog.tagsTable)
+                .order_by(tagblog.tagsTable.c.tag_id).all() == 
+                [(1, 1), (2, 1)])
+        # Same amount of statements however many tags change, including
+        # the feed rebuild done inline as tests run without job workers
+        rows = {'tags-0-id':'1', 'tags-0-name':'renamed again'}
+        for i in range(1, 50):
+            rows['tags-%d-id' % i] = ''
+            rows['tags-%d-name' % i] = 'more%d' % i
+        with self.assertQueries(14):
+            self.app.post('/edittags', data=rows)
+        assert tagblog.Tag.query.count() == 50
+
+    def test_tag_choices_cache(self):
+        self.login('admin', 'default')
+        self.app.post('/edittags', data={
+                            'tags-0-id':'', 
+                            'tags-0-name':'cachedtag'})
+        self.app.get('/')
+        with self.assertQueries(0):
+            choices = tagblog.tag_choices.get()
+        assert [name for id, name in choices] == ['cachedtag']
+        # Renaming shows up in the add post form
+        self.app.post('/edittags', data={
+                            'tags-0-id':choices[0][0], 
+                            'tags-0-name':'renamedtag'})
+        rv = self.app.get('/')
+        assert 'renamedtag' in rv.data
+        assert 'cachedtag' not in rv.data
+        # Tag added by another process, like manage.py import
+        tagblog.db.session.add(tagblog.Tag('importedtag'))
+        tagblog.bump_versions('tags')
+        tagblog.db.session.commit()
+        id = tagblog.Tag.query.filter_by(name='importedtag').one().id
+        with self.assertQueries(0):
+            assert len(tagblog.tag_choices.get()) == 1
+        # Posted tag missing from the cache is checked again
+        self.app.post('/addpost', data={'title':'imported', 'body':'body', 
+                                        'tags':[str(id)]})
+        post = tagblog.Blogpost.query.filter_by(title='imported').one()
+        assert [tag.name for tag in post.tags] == ['importedtag']
+        # Others are noticed after check_interval
+        tagblog.tag_choices.get()
+        tagblog.db.session.add(tagblog.Tag('othertag'))
+        tagblog.bump_versions('tags')
+        tagblog.db.session.commit()
+        interval = tagblog.tag_choices.check_interval
+        tagblog.tag_choices.check_interval = 0
+        try:
+            with self.assertQueries(2):
+                assert len(tagblog.tag_choices.get()) == 3
+            with self.assertQueries(1):
+                assert len(tagblog.tag_choices.get()) == 3
+        finally:
+            tagblog.tag_choices.check_interval = interval
+
     def test_blogpost_add(self):
         # First there is no posts.
         assert tagblog.Blogpost.query.count() == 0
@@ -281,6 +496,778 @@ class TagblogTestCase(unittest.TestCase):
                             })
         assert tagblog.Blogpost.query.count() == 2
         assert tagblog.Blogpost.query.get(post1.id) == None
+
+    def test_search(self):
+        self.login('admin', 'default')
+        for title, body in [('Python tips', 'Speed up python code'),
+                            ('Cooking', 'python recipes and more python'),
+                            ('Gardening', 'Nothing to see here')]:
+            self.app.post('/addpost', data={'title':title, 'body':body})
+        assert tagblog.search_posts(tagblog.tokenize('python')) == [1, 2]
+        assert tagblog.search_posts(tagblog.tokenize('PYTHON code')) == [1]
+        assert tagblog.search_posts(tagblog.tokenize('python see')) == []
+        # No limit for amount of terms
+        assert tagblog.search_posts(['python'] * 20 + ['code']) == [1]
+        rv = self.app.get('/search?query=python')
+        assert 'Python tips' in rv.data
+        assert 'Cooking' in rv.data
+        assert 'Gardening' not in rv.data
+        # Index follows edits and deletes
+        self.app.post('/editpost', data={'id':1, 'title':'Python tips',
+                                         'body':'Nothing here'})
+        assert tagblog.search_posts(['code']) == []
+        self.app.post('/deletepost', data={'postid':2})
+        assert tagblog.search_posts(['python']) == [1]
+        # Posts written without the index are found after rebuild
+        tagblog.db.session.add(tagblog.Blogpost('Gardening', 'python', []))
+        tagblog.db.session.commit()
+        tagblog.rebuild_search_index()
+        assert tagblog.search_posts(['python']) == [1, 4]
+
+    def test_search_snippets(self):
+        self.login('admin', 'default')
+        body = ' '.join(['filler'] * 50 + ['<b>Python</b> is fast'] +
+                        ['filler'] * 50)
+        self.app.post('/addpost', data={'title':'Snippets', 'body':body})
+        rv = self.app.get('/search?query=python+fast')
+        assert '&lt;b&gt;<strong>Python</strong>&lt;/b&gt; is ' \
+               '<strong>fast</strong>' in rv.data
+        assert '<b>Python' not in rv.data
+        # Snippets are cached until the post changes
+        post = tagblog.Blogpost.query.get(1)
+        key = (1, post.version, ('fast', 'python'))
+        assert tagblog.snippet_cache.get(key) is not None
+        self.app.post('/editpost', data={'id':1, 'title':'Snippets',
+                                         'body':'python is slow'})
+        rv = self.app.get('/search?query=python+fast')
+        assert 'Snippets' not in rv.data
+        rv = self.app.get('/search?query=python')
+        assert '<strong>python</strong> is slow' in rv.data
+
+    def test_jobs(self):
+        post = tagblog.Blogpost('Queued', 'python', [])
+        tagblog.db.session.add(post)
+        tagblog.db.session.commit()
+        id = post.id
+        # Jobs are committed with the change and survive until done
+        for _ in range(3):
+            tagblog.jobs.enqueue('index', id)
+        tagblog.db.session.commit()
+        tagblog.db.session.remove()
+        depth, lag = tagblog.jobs.stats()
+        assert depth == 3 and lag >= 0
+        assert tagblog.search_posts(['python']) == []
+        # Same post is indexed once
+        indexed = []
+        handler, after = tagblog.jobs._handlers['index']
+        tagblog.jobs.register('index', 
+                              lambda ids: indexed.append(ids) or handler(ids),
+                              after)
+        try:
+            assert tagblog.jobs.run_pending() == 3
+        finally:
+            tagblog.jobs.register('index', handler, after)
+        assert indexed == [[id]]
+        assert tagblog.jobs.stats() == (0, 0.0)
+        assert tagblog.search_posts(['python']) == [id]
+        # Count changes add up without recounting
+        tag = tagblog.Tag('python')
+        tagblog.db.session.add(tag)
+        tagblog.db.session.commit()
+        tag_id = tag.id
+        for kind in ('tag_added', 'tag_added', 'tag_added', 'tag_removed'):
+            tagblog.jobs.enqueue(kind, tag_id)
+        tagblog.db.session.commit()
+        with self.assertQueries(8) as statements:
+            assert tagblog.jobs.run_pending() == 4
+        assert not any('count(' in s for s in statements)
+        assert tagblog.Tag.query.get(tag_id).post_count == 2
+        # Handlers may remove the session, feeds push a request context
+        tagblog.jobs.enqueue('feed', 0)
+        tagblog.db.session.commit()
+        assert tagblog.jobs.run_pending() == 1
+        assert tagblog.jobs.stats() == (0, 0.0)
+        # Jobs done by another process meanwhile are rolled back
+        def taken(keys):
+            tagblog.db.engine.execute(tagblog.Job.__table__.delete())
+            count_tag_posts(keys)
+        count_tag_posts = tagblog.jobs._handlers['tag_added'][0]
+        tagblog.jobs.register('tag_added', taken, merge=False)
+        try:
+            tagblog.jobs.enqueue('tag_added', tag_id)
+            tagblog.db.session.commit()
+            assert tagblog.jobs.run_pending() == 0
+        finally:
+            tagblog.jobs.register('tag_added', count_tag_posts, 
+                                  after=tagblog.derived_data_changed, 
+                                  merge=False)
+        assert tagblog.jobs.stats() == (0, 0.0)
+        assert tagblog.Tag.query.get(tag_id).post_count == 2
+
+    def test_failing_jobs(self):
+        post = tagblog.Blogpost('Queued', 'python', [])
+        tagblog.db.session.add(post)
+        tagblog.db.session.commit()
+        id = post.id
+        def fail(keys):
+            raise IOError('disk full')
+        handler, after = tagblog.jobs._handlers['feed']
+        tagblog.jobs.register('feed', fail)
+        try:
+            # Failing job ahead of a good one does not hold it back
+            tagblog.jobs.enqueue('feed', 0)
+            tagblog.db.session.commit()
+            tagblog.jobs.enqueue('index', id)
+            tagblog.db.session.commit()
+            assert tagblog.jobs.run_pending() == 1
+            assert tagblog.search_posts(['python']) == [id]
+            assert tagblog.jobs.stats()[0] == 1
+            assert tagblog.Job.query.one().attempts == 1
+            # Failing job is parked after max attempts
+            for _ in range(tagblog.jobs.max_attempts):
+                assert tagblog.jobs.run_pending() == 0
+            assert tagblog.jobs.stats() == (0, 0.0)
+            job = tagblog.Job.query.one()
+            assert job.attempts == tagblog.jobs.max_attempts
+        finally:
+            tagblog.jobs.register('feed', handler, after)
+
+    def test_job_worker_survives_errors(self):
+        post = tagblog.Blogpost('Queued', 'python', [])
+        tagblog.db.session.add(post)
+        tagblog.db.session.commit()
+        id = post.id
+        queue = tagblog.JobQueue(workers=1, poll_interval=0.05)
+        queue.register('index', tagblog.index_posts)
+        run_batch = queue.run_batch
+        def broken(failed=None):
+            queue.run_batch = run_batch
+            raise RuntimeError('database went away')
+        queue.run_batch = broken
+        try:
+            queue.enqueue('index', id)
+            tagblog.db.session.commit()
+            queue.notify()
+            while queue.run_batch is broken:
+                time.sleep(0.01)
+            # Job enqueued after the failure is done by the same worker
+            queue.enqueue('index', id)
+            tagblog.db.session.commit()
+            queue.notify()
+            for _ in range(500):
+                tagblog.db.session.remove()
+                if queue.stats()[0] == 0:
+                    break
+                time.sleep(0.01)
+            assert queue.stats() == (0, 0.0)
+            assert len(queue._threads) == 1 and queue._threads[0].is_alive()
+        finally:
+            queue.stop()
+        assert tagblog.search_posts(['python']) == [id]
+
+    def test_read_replica(self):
+        replica = tempfile.mkstemp(suffix='.db')
+        os.close(replica[0])
+        tagblog.app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'sqlite:///' + replica[1]}
+        try:
+            engine = tagblog.db.get_engine(tagblog.app, 'replica')
+            tagblog.db.Model.metadata.create_all(engine)
+            engine.execute(tagblog.Blogpost.__table__.insert(), 
+                           id=1, title='From replica', body='', excerpt='')
+            tagblog.db.session.remove()
+            # Anonymous readers read from the replica
+            rv = self.app.get('/')
+            assert 'From replica' in rv.data
+            assert 'From replica' in self.app.get('/post/1').data
+            assert tagblog.Blogpost.query.count() == 0
+            # Writes and logged in users use the primary
+            self.login('admin', 'default')
+            self.app.post('/addpost', data={'title':'From primary', 
+                                            'body':'body'})
+            rv = self.app.get('/')
+            assert 'From primary' in rv.data
+            assert 'From replica' not in rv.data
+            assert tagblog.Blogpost.query.count() == 1
+        finally:
+            tagblog.db.session.remove()
+            tagblog.app.config['SQLALCHEMY_BINDS'] = None
+            os.unlink(replica[1])
+
+    def test_listing_query_count(self):
+        tags = [tagblog.Tag('tag%d' % i) for i in range(5)]
+        tagblog.db.session.add_all([
+            tagblog.Blogpost('title%d' % i, 'body', tags[:i % 5 + 1]) 
+            for i in range(3)])
+        tagblog.db.session.commit()
+        self.app.get('/')
+        self.app.get('/search?query=body')
+        # Content versions, posts and their tags.
+        # Tags of add post form are cached.
+        with self.assertQueries(3):
+            rv = self.app.get('/')
+        assert 'tag1' in rv.data
+        # Same queries for a full page
+        tagblog.db.session.add_all([
+            tagblog.Blogpost('title%d' % i, 'body', tags[:i % 5 + 1]) 
+            for i in range(3, 12)])
+        tagblog.db.session.commit()
+        tagblog.rebuild_search_index()
+        tagblog.post_counts.clear()
+        tagblog.search_results.clear()
+        self.app.get('/')
+        with self.assertQueries(3):
+            rv = self.app.get('/')
+        assert 'tag4' in rv.data
+        # Content versions, term frequencies, ranking, posts, their tags
+        # and bodies for snippets.
+        with self.assertQueries(6):
+            rv = self.app.get('/search?query=body')
+        # Further pages come from the cached results, so only the posts
+        # are queried
+        cursor = re.search(r'after=([\w-]+)', rv.data).group(1)
+        with self.assertQueries(4) as statements:
+            rv = self.app.get('/search?query=body&after=' + cursor)
+        assert not any('posting' in s for s in statements)
+        assert 'Page 2 of 2' in rv.data
+        assert 'title10' in rv.data
+
+    def test_response_cache(self):
+        tagblog.db.session.add_all([tagblog.Blogpost('title1', 'body1', []),
+                                    tagblog.Blogpost('title2', 'body2', [])])
+        tagblog.db.session.commit()
+        tagblog.app.config['RESPONSE_CACHE_ENABLED'] = True
+        try:
+            for url in ('/', '/post/1', '/post/2'):
+                rv = self.app.get(url)
+                assert 'X-Cache' not in rv.headers
+            with self.assertQueries(0):
+                for url in ('/', '/post/1', '/post/2'):
+                    rv = self.app.get(url)
+                    assert rv.headers['X-Cache'] == 'HIT'
+            assert 'title2' in rv.data
+            # Logged in users always get fresh pages
+            self.login('admin', 'default')
+            assert 'X-Cache' not in self.app.get('/').headers
+            self.app.post('/editpost', data={'id':1, 'title':'edited1',
+                                             'body':'body1'})
+            self.logout()
+            # Only pages depending on the edited post are dropped
+            assert 'edited1' in self.app.get('/').data
+            rv = self.app.get('/post/1')
+            assert 'X-Cache' not in rv.headers
+            assert 'edited1' in rv.data
+            assert self.app.get('/post/2').headers['X-Cache'] == 'HIT'
+            # Page invalidated while it was rendered is not served
+            render = tagblog.stream_template
+            def racing(*args, **kwargs):
+                tagblog.response_cache.invalidate('post:2')
+                return render(*args, **kwargs)
+            tagblog.response_cache.invalidate('post:2')
+            tagblog.stream_template = racing
+            try:
+                self.app.get('/post/2')
+            finally:
+                tagblog.stream_template = render
+            assert 'X-Cache' not in self.app.get('/post/2').headers
+        finally:
+            tagblog.app.config['RESPONSE_CACHE_ENABLED'] = False
+
+    def test_conditional_get(self):
+        tagblog.db.session.add_all([tagblog.Blogpost('title1', 'body1', []),
+                                    tagblog.Blogpost('title2', 'body2', [])])
+        tagblog.db.session.commit()
+        rv = self.app.get('/post/1')
+        etag = rv.headers['ETag']
+        modified = rv.headers['Last-Modified']
+        # Only the validators are looked up
+        with self.assertQueries(2):
+            rv = self.app.get('/post/1', headers={'If-None-Match':etag})
+        assert rv.status_code == 304
+        assert rv.data == ''
+        rv = self.app.get('/post/1', headers={'If-Modified-Since':modified})
+        assert rv.status_code == 304
+        listing_etag = self.app.get('/').headers['ETag']
+        with self.assertQueries(1):
+            rv = self.app.get('/', headers={'If-None-Match':listing_etag})
+        assert rv.status_code == 304
+        # Logged in user gets own copy
+        self.login('admin', 'default')
+        rv = self.app.get('/post/1', headers={'If-None-Match':etag})
+        assert rv.status_code == 200
+        # Editing a post changes its validators and the listing
+        self.app.post('/editpost', data={'id':1, 'title':'edited1',
+                                         'body':'body1'})
+        self.logout()
+        rv = self.app.get('/post/1', headers={'If-None-Match':etag})
+        assert rv.status_code == 200
+        assert 'edited1' in rv.data
+        rv = self.app.get('/', headers={'If-None-Match':listing_etag})
+        assert rv.status_code == 200
+        # Other posts are not affected
+        etag2 = self.app.get('/post/2').headers['ETag']
+        self.login('admin', 'default')
+        self.app.post('/editpost', data={'id':1, 'title':'edited again',
+                                         'body':'body1'})
+        self.logout()
+        rv = self.app.get('/post/2', headers={'If-None-Match':etag2})
+        assert rv.status_code == 304
+
+    def test_import_export(self):
+        tag = tagblog.Tag('existing')
+        tagblog.db.session.add(tagblog.Blogpost('old', 'old body', [tag]))
+        tagblog.db.session.commit()
+        lines = [json.dumps({'title':'title%d' % i, 'body':'body %d' % i,
+                             'tags':['existing', 'tag%d' % (i % 3)]})
+                 for i in range(10)]
+        reports = []
+        assert manage.import_posts(lines, chunk_size=4, 
+                                   report=reports.append) == 10
+        assert reports == [4, 8, 10]
+        assert tagblog.Blogpost.query.count() == 11
+        assert tagblog.Tag.query.count() == 4
+        post = tagblog.Blogpost.query.filter_by(title='title4').one()
+        assert sorted(t.name for t in post.tags) == ['existing', 'tag1']
+        assert tagblog.search_posts(['4']) == [post.id]
+        out = StringIO()
+        assert manage.export_posts(out, chunk_size=3) == 11
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert [r['id'] for r in records] == range(1, 12)
+        assert records[0] == {'id':1, 'title':'old', 'body':'old body',
+                              'tags':['existing']}
+        assert records[5]['tags'] == ['existing', 'tag1']
+        # Post added straight to the session is not counted
+        assert tagblog.Tag.query.filter_by(name='existing').one().post_count == 10
+        # Round trip into an empty database keeps ids
+        tagblog.db.drop_all()
+        tagblog.db.create_all()
+        manage.import_posts(out.getvalue().splitlines(), keep_ids=True)
+        exported = StringIO()
+        manage.export_posts(exported)
+        assert exported.getvalue() == out.getvalue()
+
+    def test_statement_timeout(self):
+        info = make_url('postgresql://tagblog@localhost/tagblog')
+        def timeout():
+            options = {}
+            tagblog.db.apply_driver_hacks(tagblog.app, info, options)
+            return options.get('connect_args', {}).get('options')
+        tagblog.app.config['SQLALCHEMY_STATEMENT_TIMEOUT'] = 30000
+        try:
+            assert timeout() == '-c statement_timeout=30000'
+            # Maintenance commands run without the timeout of requests
+            manage.main(['jobs', '--stats'])
+            assert timeout() is None
+            manage.main(['--statement-timeout', '600000', 'jobs', '--stats'])
+            assert timeout() == '-c statement_timeout=600000'
+        finally:
+            tagblog.app.config.pop('SQLALCHEMY_STATEMENT_TIMEOUT', None)
+
+    def test_migrate(self):
+        # Database of the first release with one post
+        tagblog.db.drop_all()
+        tagblog.db.session.remove()
+        metadata = tagblog.db.MetaData()
+        Column, Integer, String = (tagblog.db.Column, tagblog.db.Integer, 
+                                   tagblog.db.String)
+        tagblog.db.Table('user', metadata, 
+                         Column('id', Integer, primary_key=True),
+                         Column('username', String(80), unique=True),
+                         Column('_pw_hash', String(170)))
+        tag = tagblog.db.Table('tag', metadata, 
+                               Column('id', Integer, primary_key=True),
+                               Column('name', String(80), unique=True))
+        post = tagblog.db.Table('blogpost', metadata, 
+                                Column('id', Integer, primary_key=True),
+                                Column('title', String(80)),
+                                Column('body', tagblog.db.Text))
+        tags = tagblog.db.Table('tags', metadata, 
+                                Column('tag_id', Integer), 
+                                Column('blogpost_id', Integer))
+        metadata.create_all(tagblog.db.engine)
+        tagblog.db.engine.execute(tag.insert(), id=1, name='old')
+        tagblog.db.engine.execute(post.insert(), id=1, title='Old post', 
+                                  body='written before migrations')
+        tagblog.db.engine.execute(tags.insert(), tag_id=1, blogpost_id=1)
+        assert manage.schema_version() is None
+        assert manage.migrate() == [1, 2, 3, 4, 5, 6]
+        assert manage.schema_version() == manage.MIGRATIONS[-1][0]
+        assert manage.migrate() == []
+        tagblog.db.session.remove()
+        post = tagblog.Blogpost.query.get(1)
+        assert post.version == 1 and post.updated is not None
+        assert post.excerpt == 'written before migrations'
+        assert tagblog.Tag.query.get(1).post_count == 1
+        assert tagblog.search_posts(['migrations']) == [1]
+        assert tagblog.jobs.stats() == (0, 0.0)
+        # Empty database gets current schema
+        tagblog.db.drop_all()
+        tagblog.db.session.execute('DROP TABLE IF EXISTS user')
+        tagblog.db.session.commit()
+        assert manage.migrate() == []
+        assert manage.schema_version() == manage.MIGRATIONS[-1][0]
+        assert tagblog.Blogpost.query.count() == 0
+
+    def test_feeds(self):
+        tag = tagblog.Tag('python')
+        tagblog.db.session.add(tag)
+        tagblog.db.session.commit()
+        self.login('admin', 'default')
+        self.app.post('/addpost', data={'title':'First <post>', 
+                                        'body':'body1', 'tags':['1']})
+        self.app.post('/addpost', data={'title':'Second', 'body':'body2'})
+        rv = self.app.get('/feed.atom')
+        assert rv.mimetype == 'application/atom+xml'
+        assert rv.data.index('Second') < rv.data.index('First &lt;post&gt;')
+        assert 'http://localhost/post/1' in rv.data
+        feed = json.loads(self.app.get('/feed.json').data)
+        assert [item['title'] for item in feed['items']] == \
+               ['Second', 'First <post>']
+        assert feed['items'][1]['tags'] == ['python']
+        feed = json.loads(self.app.get('/tag/python/feed.json').data)
+        assert [item['title'] for item in feed['items']] == ['First <post>']
+        assert self.app.get('/tag/nothing/feed.json').status_code == 404
+        # Compressed copy for clients accepting it
+        rv = self.app.get('/feed.json', 
+                          headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(GzipFile(fileobj=StringIO(rv.data)).read()) == \
+               json.loads(self.app.get('/feed.json').data)
+        rv = self.app.get('/feed.json', 
+                          headers={'Accept-Encoding': 'gzip', 
+                                   'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+        # Feeds are rebuilt on writes and served without database
+        self.app.post('/editpost', data={'id':1, 'title':'Edited', 
+                                         'body':'body1'})
+        self.app.post('/deletepost', data={'postid':2})
+        with self.assertQueries(0):
+            feed = json.loads(self.app.get('/feed.json').data)
+            tag_feed = json.loads(self.app.get('/tag/python/feed.json').data)
+        assert [item['title'] for item in feed['items']] == ['Edited']
+        assert tag_feed['items'] == []
+        # Renamed tags show up in the feed of all posts
+        self.app.post('/editpost', data={'id':1, 'title':'Edited', 
+                                         'body':'body1', 'tags':['1']})
+        self.app.post('/edittags', data={'tags-0-id':'1', 
+                                         'tags-0-name':'renamed'})
+        feed = json.loads(self.app.get('/feed.json').data)
+        assert feed['items'][0]['tags'] == ['renamed']
+        # Tags renamed by another process make cached entries stale
+        tagblog.Tag.query.get(1).name = 'elsewhere'
+        tagblog.bump_versions('tags')
+        tagblog.db.session.commit()
+        tagblog.jobs.enqueue('feed', 0)
+        tagblog.db.session.commit()
+        tagblog.jobs.notify()
+        feed = json.loads(self.app.get('/feed.json').data)
+        assert feed['items'][0]['tags'] == ['elsewhere']
+
+    def test_assets(self):
+        manifest = manage.build_assets()
+        assert sorted(manifest) == ['css/site.css', 'js/site.js']
+        assert re.match(r'js/site\.[0-9a-f]{12}\.js$', manifest['js/site.js'])
+        assert manage.build_assets() == manifest
+        rv = self.app.get('/')
+        css = '/static/build/' + manifest['css/site.css']
+        assert 'href="%s"' % css in rv.data
+        assert 'googleapis.com/ajax' not in rv.data
+        rv = self.app.get(css)
+        assert rv.mimetype == 'text/css'
+        assert 'immutable' in rv.headers['Cache-Control']
+        assert 'url("../../img/glyphicons-halflings.png")' in rv.data
+        assert 'body{padding-top: 60px' in rv.data
+        js = self.app.get('/static/build/' + manifest['js/site.js'],
+                          headers={'Accept-Encoding': 'gzip'})
+        assert js.headers['Content-Encoding'] == 'gzip'
+        js = GzipFile(fileobj=StringIO(js.data)).read()
+        assert js.index('jQuery v1.10.1') < js.index('Bootstrap.js')
+        if manage.brotli is not None:
+            rv = self.app.get('/static/build/' + manifest['js/site.js'],
+                              headers={'Accept-Encoding': 'br, gzip'})
+            assert rv.headers['Content-Encoding'] == 'br'
+            assert manage.brotli.decompress(rv.data) == js
+        assert self.app.get('/static/build/manifest.json').status_code == 404
+        assert manage.minify_css('/* x */ a  {\n color: red; }') == \
+               'a{color: red}'
+        assert manage.jquery_version(
+            '/*! jQuery v1.10.1 | (c) 2005, 2013 jQuery Foundation') == '1.10.1'
+        assert manage.jquery_version('/* Bootstrap.js */') is None
+
+    def test_export_site(self):
+        tagblog.db.session.add(tagblog.Tag('python'))
+        tagblog.db.session.commit()
+        self.login('admin', 'default')
+        for i in range(12):
+            self.app.post('/addpost', data={'title':'title%02d' % i,
+                                            'body':'body', 'tags':['1']})
+        directory = tempfile.mkdtemp()
+        read = lambda name: open(os.path.join(directory, 'current',
+                                              name)).read()
+        # 2 index pages, 2 tag pages, tags page, 12 posts and assets
+        assert manage.export_site(directory, processes=1) == \
+               17 + len(manage.site_assets())
+        index = read('index.html')
+        assert 'title00' in index and 'title10' not in index
+        assert 'href="/2"' in index and 'after=' not in index
+        assert 'action="/search"' not in index and 'name="password"' not in index
+        assert 'title10' in read('2/index.html')
+        assert 'href="/tag/python/2"' in read('tag/python/index.html')
+        assert 'title11' in read('tag/python/2/index.html')
+        assert 'id="editpostmodal"' not in read('post/3/index.html')
+        assert read('static/css/bootstrap.css')
+        assert os.readlink(os.path.join(directory, 'current')) == \
+               os.path.join('generations', '1')
+        # Only pages showing the changed posts are rendered again:
+        # both index and tag pages, the tags page and the edited post
+        self.app.post('/editpost', data={'id':12, 'title':'edited',
+                                         'body':'body', 'tags':['1']})
+        self.app.post('/deletepost', data={'postid':3})
+        assert manage.export_site(directory, processes=1) == 6
+        assert 'edited' in read('post/12/index.html')
+        assert 'edited' in read('2/index.html')
+        assert not os.path.exists(os.path.join(directory, 'current', 'post/3'))
+        assert 'title00' in open(os.path.join(
+            directory, 'generations', '1', 'index.html')).read()
+        assert manage.export_site(directory, processes=1) == 0
+        assert sorted(os.listdir(os.path.join(directory, 'generations'))) == \
+               ['2', '3']
+        # Normal pages still use cursors and forms
+        rv = self.app.get('/')
+        assert 'after=' in rv.data and 'action="/search"' in rv.data
+
+    def test_tag_pages(self):
+        tags = [tagblog.Tag('tag%d' % i) for i in range(3)]
+        tagblog.db.session.add_all(tags)
+        tagblog.db.session.commit()
+        self.login('admin', 'default')
+        for i in range(15):
+            self.app.post('/addpost', data={'title':'title%02d' % i, 
+                                            'body':'body', 
+                                            'tags':[1, 2 + i % 2]})
+        counts = lambda: [t.post_count for t in 
+                          tagblog.Tag.query.order_by(tagblog.Tag.id)]
+        assert counts() == [15, 8, 7]
+        self.app.post('/editpost', data={'id':1, 'title':'title00', 
+                                         'body':'body', 'tags':[3]})
+        assert counts() == [14, 7, 8]
+        self.app.post('/deletepost', data={'postid':2})
+        assert counts() == [13, 7, 7]
+        tagblog.recount_tags()
+        assert counts() == [13, 7, 7]
+        self.logout()
+        rv = self.app.get('/tag/tag2')
+        assert 'Posts tagged tag2' in rv.data
+        assert 'title00' in rv.data and 'title01' not in rv.data
+        assert 'title03' in rv.data and 'title02' not in rv.data
+        assert 'Page 1 of 1' not in rv.data
+        rv = self.app.get('/tag/tag0')
+        assert 'Page 1 of 2' in rv.data
+        assert 'title00' not in rv.data and 'title11' in rv.data
+        rv = self.app.get('/tag/tag0?after=' + tagblog.encode_cursor(2, 12))
+        assert 'title12' in rv.data and 'title14' in rv.data
+        assert 'title11' not in rv.data
+        assert self.app.get('/tag/missing').status_code == 404
+        assert 'Page 2 of 2' in self.app.get('/tag/tag0/2').data
+        assert self.app.get('/tag/tag0/3').status_code == 404
+        rv = self.app.get('/tags')
+        assert 'title="13 posts">tag0</a>' in rv.data
+        assert 'title="7 posts">tag2</a>' in rv.data
+
+    def test_tag_filter(self):
+        assert tagblog.parse_tag_filter(
+            'python AND performance NOT draft OR "not first"') == [
+                (frozenset(['python', 'performance']), frozenset(['draft'])),
+                (frozenset(['not first']), frozenset())]
+        assert tagblog.parse_tag_filter('a NOT a') == []
+        names = ['python', 'performance', 'draft', 'common', 'not first']
+        tags = dict((name, tagblog.Tag(name)) for name in names)
+        tagged = [['python', 'performance', 'common'],
+                  ['python', 'performance', 'draft', 'common'],
+                  ['python', 'common'],
+                  ['performance'],
+                  ['not first', 'common'],
+                  []]
+        for i, names in enumerate(tagged):
+            tagblog.db.session.add(tagblog.Blogpost(
+                'title%d' % (i + 1), 'words', [tags[n] for n in names]))
+        tagblog.db.session.commit()
+        tagblog.recount_tags()
+        tagblog.rebuild_search_index()
+        def ids(text):
+            query = tagblog.tag_filter_query(tagblog.parse_tag_filter(text))
+            if query is None:
+                return []
+            return sorted(row[0] for row in tagblog.db.session.execute(query))
+        assert ids('python AND performance NOT draft') == [1]
+        assert ids('python performance') == [1, 2]
+        assert ids('common NOT python') == [5]
+        assert ids('NOT common') == [4, 6]
+        assert ids('draft OR "not first"') == [2, 5]
+        assert ids('python OR missing') == [1, 2, 3]
+        assert ids('missing') == []
+        assert ids('NOT missing') == [1, 2, 3, 4, 5, 6]
+        rv = self.app.get('/search?tags=python+NOT+draft')
+        assert 'title1' in rv.data and 'title3' in rv.data
+        assert 'title2' not in rv.data and 'title4' not in rv.data
+        # Combined with text search
+        rv = self.app.get('/search?query=words&tags=performance')
+        assert 'title1' in rv.data and 'title4' in rv.data
+        assert 'title3' not in rv.data
+        rv = self.app.get('/search?query=words&tags=missing')
+        assert 'No posts found' in rv.data
+        # Removing a tag drops results cached by tag names
+        rv = self.app.get('/search?query=words&tags=python+NOT+draft')
+        assert 'title1' in rv.data and 'title2' not in rv.data
+        self.login('admin', 'default')
+        rows = {}
+        for i, (id, name) in enumerate(
+                tagblog.db.session.query(tagblog.Tag.id, tagblog.Tag.name)):
+            rows['tags-%d-id' % i] = id
+            rows['tags-%d-name' % i] = '' if name == 'draft' else name
+        self.app.post('/edittags', data=rows)
+        self.logout()
+        rv = self.app.get('/search?query=words&tags=python+NOT+draft')
+        assert 'title1' in rv.data and 'title2' in rv.data
+
+    def test_slim_reads(self):
+        tags = [tagblog.Tag('python'), tagblog.Tag('flask')]
+        tagblog.db.session.add_all(
+            [tagblog.Blogpost('title1', 'first body', tags),
+             tagblog.Blogpost('title2', 'second body', tags[:1])])
+        tagblog.db.session.commit()
+        tagblog.db.session.remove()
+        with tagblog.app.test_request_context('/'):
+            tagblog.app.preprocess_request()
+            posts = tagblog.listed_posts([2, 1])
+            assert [type(post) for post in posts] == [tagblog.PostRow] * 2
+            assert [post.title for post in posts] == ['title2', 'title1']
+            assert [tag.name for tag in posts[1].tags] == ['flask', 'python']
+            assert posts[1].body is None
+            assert not tagblog.db.session.identity_map
+        # Pages are the same whichever shape the posts have
+        paths = ['/', '/post/1', '/search?query=body', '/search?tags=python']
+        pages = [self.app.get(path).data for path in paths]
+        assert 'title1' in pages[0] and 'first body' in pages[1]
+        tagblog.app.config['SLIM_READS'] = False
+        try:
+            assert [self.app.get(path).data for path in paths] == pages
+        finally:
+            tagblog.app.config['SLIM_READS'] = True
+
+    def test_streaming_and_gzip(self):
+        tagblog.db.session.add(tagblog.Blogpost('title', 'body ' * 500, []))
+        tagblog.db.session.commit()
+        # Flashed message is shown once on a streamed page
+        rv = self.app.get('/search', follow_redirects=True)
+        assert 'Search query not present' in rv.data
+        assert 'name="password"' in rv.data
+        assert 'Content-Length' not in rv.headers
+        assert 'Search query not present' not in self.app.get('/').data
+        plain = self.app.get('/post/1')
+        rv = self.app.get('/post/1', headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert rv.headers['Vary'] == 'Cookie, Accept-Encoding'
+        assert rv.headers['ETag'] == 'W/' + plain.headers['ETag']
+        assert GzipFile(fileobj=StringIO(rv.data)).read() == plain.data
+        rv = self.app.get('/post/1', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+        # Short bodies and other content types are not compressed
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', environ['PATH_INFO'][1:])])
+            return iter(['x' * 600, 'x' * 600])
+        for path, size, encoded in (('/text/html', 1000, True),
+                                    ('/text/html', 2000, False),
+                                    ('/image/png', 1000, False)):
+            middleware = tagblog.GzipMiddleware(app, minimum_size=size)
+            headers = []
+            body = ''.join(middleware(
+                {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                lambda status, found, exc_info=None: headers.extend(found)))
+            assert (('Content-Encoding', 'gzip') in headers) == encoded
+            if not encoded:
+                assert body == 'x' * 1200
+
+    def test_instrumentation(self):
+        assert self.app.get('/metrics').status_code == 404
+        tagblog.instrumentation.enable()
+        tagblog.app.config['SERVER_TIMING'] = True
+        try:
+            tagblog.instrumentation.reset()
+            rv = self.app.get('/')
+            assert 'sql;dur=' in rv.headers['Server-Timing']
+            assert self.app.get('/metrics').status_code == 403
+            self.login('admin', 'default')
+            rv = self.app.get('/metrics')
+            assert rv.status_code == 200
+            assert '# TYPE tagblog_request_seconds histogram' in rv.data
+            # Login redirected to index again
+            assert ('tagblog_request_seconds_count{endpoint="index"} 2' 
+                    in rv.data)
+            assert ('tagblog_request_sql_statements_bucket'
+                    '{endpoint="index",le="+Inf"} 2' in rv.data)
+            assert ('tagblog_template_render_seconds_count'
+                    '{template="index.html"} 2' in rv.data)
+            assert ('tagblog_form_construct_seconds_count'
+                    '{form="BlogpostForm"}' in rv.data)
+            # Streamed pages are recorded after they are rendered
+            sums = dict(re.findall(r'^(\S+) (\S+)$', rv.data, re.M))
+            assert (float(sums['tagblog_request_seconds_sum'
+                               '{endpoint="index"}']) >= 
+                    float(sums['tagblog_template_render_seconds_sum'
+                               '{template="index.html"}']))
+            tagblog.app.config['METRICS_TOKEN'] = 'secret'
+            assert self.app.get('/metrics').status_code == 403
+            rv = self.app.get('/metrics', headers={
+                'Authorization':'Bearer secret'})
+            assert rv.status_code == 200
+        finally:
+            tagblog.instrumentation.disable()
+            tagblog.app.config['SERVER_TIMING'] = False
+            tagblog.app.config.pop('METRICS_TOKEN', None)
+        assert 'Server-Timing' not in self.app.get('/').headers
+
+    def test_pagination(self):
+        tagblog.db.session.add_all([
+            tagblog.Blogpost('title%03d' % i, 'common body', []) 
+            for i in range(1, 26)])
+        tagblog.db.session.commit()
+        tagblog.rebuild_search_index()
+        rv = self.app.get('/')
+        assert 'title001' in rv.data and 'title010' in rv.data
+        assert 'title011' not in rv.data
+        assert 'Page 1 of 3' in rv.data
+        next_cursor = tagblog.encode_cursor(2, 10)
+        assert '?after=' + next_cursor in rv.data
+        rv = self.app.get('/?after=' + next_cursor)
+        assert 'title011' in rv.data and 'title020' in rv.data
+        assert 'title010' not in rv.data and 'title021' not in rv.data
+        assert 'Page 2 of 3' in rv.data
+        # Prev goes back to the first page
+        rv = self.app.get('/?before=' + tagblog.encode_cursor(1, 11))
+        assert 'title001' in rv.data and 'title010' in rv.data
+        assert 'title011' not in rv.data
+        # Old numbered urls still work
+        rv = self.app.get('/3')
+        assert 'title021' in rv.data and 'title025' in rv.data
+        assert 'title020' not in rv.data
+        assert 'Page 3 of 3' in rv.data
+        assert self.app.get('/4').status_code == 404
+        assert self.app.get('/99').status_code == 404
+        # Broken cursor falls back to first page
+        assert 'title001' in self.app.get('/?after=garbage').data
+        # Search results are paginated by (score, id)
+        rv = self.app.get('/search?query=common')
+        assert 'title010' in rv.data and 'title011' not in rv.data
+        assert 'Page 1 of 3' in rv.data
+        ranked, score = tagblog.search_query(['common'])
+        top_score = ranked.order_by(score.desc()).first()[1]
+        rv = self.app.get('/search?query=common&after=' + 
+                          tagblog.encode_cursor(2, top_score, 10))
+        assert 'title011' in rv.data and 'title020' in rv.data
+        assert 'title010' not in rv.data and 'title021' not in rv.data
        
 
 
@@ -1,2 +1,7 @@
 SQLALCHEMY_DATABASE_URI = 'sqlite:///testing.db'
-CSRF_ENABLED = False
\ No newline at end of file
+CSRF_ENABLED = False
+PASSWORD_HASH_ITERATIONS = 1000
+JOB_WORKERS = 0
+import tempfile
+FEED_DIR = tempfile.mkdtemp()
+ASSET_DIR = tempfile.mkdtemp()